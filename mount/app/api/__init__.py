@@ -1,4 +1,9 @@
 from app.models.redis_cache import RedisCache
+from app.models.ping_buffer import PingBuffer
+from app.models.channel_registry import ChannelRegistry
+from app.models.bcrypt_pool import BcryptPool
+from app.models.admission_limiter import AdmissionLimiter
+from app.models.presence_snapshot import PresenceSnapshot
 from app.common import logger
 from app.common import settings
 
@@ -8,10 +13,14 @@ from app.common.aioredlock import Aioredlock
 from app.usecases import users as users_usecases
 from app.usecases import tokens as tokens_usecases
 from app.usecases import channels as channels_usecases
+from app.usecases import streams as streams_usecases
+from app.usecases import schedules as schedules_usecases
+from app.usecases import restarts as restarts_usecases
 from app.common.context import Context
 from geoip2.database import Reader
 
 import aioredis
+import asyncio
 
 
 def mysql_dsn(username: str, password: str, host: str, port: int, database: str) -> str:
@@ -60,9 +69,13 @@ class ContextProxy(Context):
         return self.app.state.redis
 
     @property
-    def bcrypt_cache(self) -> RedisCache[str]:
+    def bcrypt_cache(self) -> RedisCache[bool]:
         return self.app.state.bcrypt_cache
 
+    @property
+    def bcrypt_pool(self) -> BcryptPool:
+        return self.app.state.bcrypt_pool
+
     @property
     def lock_manager(self) -> Aioredlock:
         return self.app.state.lock_manager
@@ -71,6 +84,71 @@ class ContextProxy(Context):
     def geolocation_reader(self) -> Reader:
         return self.app.state.geolocation_reader
 
+    @property
+    def ping_buffer(self) -> PingBuffer:
+        return self.app.state.ping_buffer
+
+    @property
+    def channel_registry(self) -> ChannelRegistry:
+        return self.app.state.channel_registry
+
+    @property
+    def side_effect_limiter(self) -> asyncio.Semaphore:
+        return self.app.state.side_effect_limiter
+
+    @property
+    def login_admission(self) -> AdmissionLimiter:
+        return self.app.state.login_admission
+
+    @property
+    def presence_snapshot(self) -> PresenceSnapshot:
+        return self.app.state.presence_snapshot
+
+
+EPHEMERAL_TABLES = (
+    "tokens",
+    "token_states",
+    "token_buffers",
+    "streams",
+    "stream_tokens",
+    "channels",
+)
+EPHEMERAL_KEY_PATTERNS = (
+    "akatsuki:tokens:*",
+    "akatsuki:streams:*",
+    "akatsuki:channels:*",
+    "akatsuki:sessions:*",
+)
+EPHEMERAL_SCAN_COUNT = 1000
+
+
+async def clear_ephemeral_state(app: FastAPI) -> None:
+    ctx = ContextProxy(app)
+
+    for table in EPHEMERAL_TABLES:
+        await ctx.database.execute(f"TRUNCATE TABLE {table}")
+
+    for pattern in EPHEMERAL_KEY_PATTERNS:
+        keys = []
+        async for key in ctx.redis.scan_iter(match=pattern, count=EPHEMERAL_SCAN_COUNT):
+            keys.append(key)
+
+            if len(keys) >= EPHEMERAL_SCAN_COUNT:
+                await ctx.redis.unlink(*keys)
+                keys.clear()
+
+        if keys:
+            await ctx.redis.unlink(*keys)
+
+
+async def instantiate_streams(app: FastAPI) -> None:
+    ctx = ContextProxy(app)
+
+    # every token joins main on creation, so it must always exist
+    stream = await streams_usecases.fetch_one(ctx, "main")
+    if stream is None:
+        await streams_usecases.create_one(ctx, "main")
+
 
 async def instantiate_channels(app: FastAPI) -> None:
     ctx = ContextProxy(app)
@@ -98,7 +176,7 @@ async def instantiate_channels(app: FastAPI) -> None:
 async def connect_aika(app: FastAPI) -> None:
     ctx = ContextProxy(app)
 
-    aika = await tokens_usecases.fetch_one(ctx, user_id=999)
+    aika = await tokens_usecases.fetch_session(ctx, user_id=999)
     if aika is not None:
         return
 
@@ -119,6 +197,89 @@ async def connect_aika(app: FastAPI) -> None:
     )
 
 
+async def reap_stale_tokens(app: FastAPI) -> None:
+    ctx = ContextProxy(app)
+
+    while True:
+        await asyncio.sleep(settings.TOKEN_REAPER_INTERVAL)
+
+        try:
+            while True:
+                expired = await tokens_usecases.expire_stale_tokens(ctx)
+                if expired:
+                    logger.info("Expired stale tokens", count=expired)
+
+                if expired < settings.TOKEN_REAPER_BATCH_SIZE:
+                    break
+        except Exception:
+            logger.error("Failed to expire stale tokens", exc_info=True)
+
+
+async def run_scheduler(app: FastAPI) -> None:
+    ctx = ContextProxy(app)
+
+    while True:
+        await asyncio.sleep(settings.SCHEDULER_INTERVAL)
+
+        try:
+            await schedules_usecases.seed(ctx)
+
+            while True:
+                processed = await schedules_usecases.process_due(ctx)
+                if processed < settings.SCHEDULER_BATCH_SIZE:
+                    break
+        except Exception:
+            logger.error("Failed to run scheduler", exc_info=True)
+
+
+async def flush_ping_times(app: FastAPI) -> None:
+    ctx = ContextProxy(app)
+
+    while True:
+        await asyncio.sleep(settings.PING_FLUSH_INTERVAL)
+
+        try:
+            await tokens_usecases.flush_ping_times(ctx)
+        except Exception:
+            logger.error("Failed to flush ping times", exc_info=True)
+
+
+def init_channel_registry(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_channel_registry() -> None:
+        logger.info("Initializing channel registry")
+
+        app.state.channel_registry = ChannelRegistry()
+
+        logger.info("Initialized channel registry")
+
+    @app.on_event("shutdown")
+    async def shutdown_channel_registry() -> None:
+        logger.info("Destroying channel registry")
+
+        del app.state.channel_registry
+
+        logger.info("Destroyed channel registry")
+
+
+def init_presence_snapshot(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_presence_snapshot() -> None:
+        logger.info("Initializing presence snapshot")
+
+        app.state.presence_snapshot = PresenceSnapshot()
+
+        logger.info("Initialized presence snapshot")
+
+    @app.on_event("shutdown")
+    async def shutdown_presence_snapshot() -> None:
+        logger.info("Destroying presence snapshot")
+
+        del app.state.presence_snapshot
+
+        logger.info("Destroyed presence snapshot")
+
+
 def init_redis(app: FastAPI) -> None:
     @app.on_event("startup")
     async def startup_redis() -> None:
@@ -133,6 +294,11 @@ def init_redis(app: FastAPI) -> None:
         app.state.redis = redis
         logger.info("Connected to redis")
 
+        if settings.CLEAR_EPHEMERAL_STATE:
+            logger.info("Clearing ephemeral state")
+            await clear_ephemeral_state(app)
+
+        await instantiate_streams(app)
         await connect_aika(app)
         await instantiate_channels(app)
 
@@ -151,8 +317,11 @@ def init_bcrypt_cache(app: FastAPI) -> None:
     async def startup_bcrypt_cache() -> None:
         logger.info("Initializing bcrypt cache")
 
-        bcrypt_cache: RedisCache[str] = RedisCache(
-            app.state.redis, "akatsuki:cache:bcrypt"
+        bcrypt_cache: RedisCache[bool] = RedisCache(
+            app.state.redis,
+            "akatsuki:cache:bcrypt",
+            ttl=settings.BCRYPT_CACHE_TTL,
+            max_local_size=settings.BCRYPT_CACHE_LOCAL_SIZE,
         )
         app.state.bcrypt_cache = bcrypt_cache
 
@@ -160,13 +329,46 @@ def init_bcrypt_cache(app: FastAPI) -> None:
 
     @app.on_event("shutdown")
     async def shutdown_bcrypt_cache() -> None:
-        logger.info("Destroying bcrypt cache")
+        logger.info(
+            "Destroying bcrypt cache",
+            local_hits=app.state.bcrypt_cache.local_hits,
+            hits=app.state.bcrypt_cache.hits,
+            misses=app.state.bcrypt_cache.misses,
+        )
 
         del app.state.bcrypt_cache
 
         logger.info("Destroyed bcrypt cache")
 
 
+def init_bcrypt_pool(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_bcrypt_pool() -> None:
+        logger.info("Initializing bcrypt pool")
+
+        app.state.bcrypt_pool = BcryptPool(
+            settings.BCRYPT_WORKERS,
+            settings.BCRYPT_MAX_PENDING,
+        )
+
+        logger.info("Initialized bcrypt pool")
+
+    @app.on_event("shutdown")
+    async def shutdown_bcrypt_pool() -> None:
+        logger.info(
+            "Destroying bcrypt pool",
+            pending=app.state.bcrypt_pool.pending,
+            completed=app.state.bcrypt_pool.completed,
+            rejected=app.state.bcrypt_pool.rejected,
+            average_latency_ms=app.state.bcrypt_pool.average_latency_ms,
+        )
+
+        app.state.bcrypt_pool.shutdown()
+        del app.state.bcrypt_pool
+
+        logger.info("Destroyed bcrypt pool")
+
+
 def init_lock_manager(app: FastAPI) -> None:
     @app.on_event("startup")
     async def startup_lock_manager() -> None:
@@ -197,6 +399,146 @@ def init_geolocation_reader(app: FastAPI) -> None:
         logger.info("Initialized geolocation reader")
 
 
+def init_ping_buffer(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_ping_buffer() -> None:
+        logger.info("Initializing ping buffer")
+
+        assert settings.PING_FLUSH_INTERVAL < settings.PING_TIMEOUT
+
+        app.state.ping_buffer = PingBuffer()
+        app.state.ping_flusher = asyncio.create_task(flush_ping_times(app))
+
+        logger.info("Initialized ping buffer")
+
+    async def shutdown_ping_buffer() -> None:
+        logger.info("Flushing ping buffer")
+
+        app.state.ping_flusher.cancel()
+        del app.state.ping_flusher
+
+        await tokens_usecases.flush_ping_times(ContextProxy(app))
+        del app.state.ping_buffer
+
+        logger.info("Flushed ping buffer")
+
+    # the final flush must run before the database and redis disconnect
+    app.router.on_shutdown.insert(0, shutdown_ping_buffer)
+
+
+def init_graceful_restart(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_graceful_restart() -> None:
+        # a previous instance's restart is over once we're up
+        await restarts_usecases.end_restart(ContextProxy(app))
+
+    async def shutdown_graceful_restart() -> None:
+        if not settings.GRACEFUL_RESTART:
+            return
+
+        ctx = ContextProxy(app)
+        if not await restarts_usecases.begin_restart(ctx):
+            return
+
+        logger.info("Logging out instance tokens")
+
+        logged_out = await restarts_usecases.log_out_instance_tokens(ctx)
+
+        logger.info("Logged out instance tokens", count=logged_out)
+
+    # must run before the database and redis disconnect
+    app.router.on_shutdown.insert(0, shutdown_graceful_restart)
+
+
+def init_token_reaper(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_token_reaper() -> None:
+        logger.info("Starting token reaper")
+
+        app.state.token_reaper = asyncio.create_task(reap_stale_tokens(app))
+
+        logger.info("Started token reaper")
+
+    async def shutdown_token_reaper() -> None:
+        logger.info("Stopping token reaper")
+
+        app.state.token_reaper.cancel()
+        del app.state.token_reaper
+
+        logger.info("Stopped token reaper")
+
+    # must stop before the database and redis disconnect
+    app.router.on_shutdown.insert(0, shutdown_token_reaper)
+
+
+def init_scheduler(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_scheduler() -> None:
+        logger.info("Starting scheduler")
+
+        await schedules_usecases.seed(ContextProxy(app))
+        app.state.scheduler = asyncio.create_task(run_scheduler(app))
+
+        logger.info("Started scheduler")
+
+    async def shutdown_scheduler() -> None:
+        logger.info("Stopping scheduler")
+
+        app.state.scheduler.cancel()
+        del app.state.scheduler
+
+        logger.info("Stopped scheduler")
+
+    # must stop before the database and redis disconnect
+    app.router.on_shutdown.insert(0, shutdown_scheduler)
+
+
+def init_side_effect_limiter(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_side_effect_limiter() -> None:
+        logger.info("Initializing side effect limiter")
+
+        app.state.side_effect_limiter = asyncio.Semaphore(
+            settings.SIDE_EFFECT_CONCURRENCY,
+        )
+
+        logger.info("Initialized side effect limiter")
+
+    @app.on_event("shutdown")
+    async def shutdown_side_effect_limiter() -> None:
+        logger.info("Destroying side effect limiter")
+
+        del app.state.side_effect_limiter
+
+        logger.info("Destroyed side effect limiter")
+
+
+def init_login_admission(app: FastAPI) -> None:
+    @app.on_event("startup")
+    async def startup_login_admission() -> None:
+        logger.info("Initializing login admission")
+
+        app.state.login_admission = AdmissionLimiter(
+            settings.LOGIN_CONCURRENCY,
+            settings.LOGIN_QUEUE_SIZE,
+        )
+
+        logger.info("Initialized login admission")
+
+    @app.on_event("shutdown")
+    async def shutdown_login_admission() -> None:
+        logger.info(
+            "Destroying login admission",
+            queued=app.state.login_admission.queued,
+            admitted=app.state.login_admission.admitted,
+            rejected=app.state.login_admission.rejected,
+        )
+
+        del app.state.login_admission
+
+        logger.info("Destroyed login admission")
+
+
 def init_routes(app: FastAPI) -> None:
     from . import bancho
 
@@ -207,10 +549,19 @@ def init_api() -> FastAPI:
     app = FastAPI()
 
     init_db(app)
+    init_channel_registry(app)
+    init_presence_snapshot(app)
     init_redis(app)
     init_bcrypt_cache(app)
+    init_bcrypt_pool(app)
     init_lock_manager(app)
     init_geolocation_reader(app)
+    init_ping_buffer(app)
+    init_token_reaper(app)
+    init_graceful_restart(app)
+    init_scheduler(app)
+    init_side_effect_limiter(app)
+    init_login_admission(app)
     init_routes(app)
 
     return app
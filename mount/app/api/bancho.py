@@ -2,6 +2,7 @@ from fastapi import APIRouter
 from fastapi import Request
 from fastapi import Response
 from fastapi import Depends
+from fastapi import BackgroundTasks
 from datetime import datetime
 from datetime import timedelta
 
@@ -11,13 +12,19 @@ from app.usecases import users as users_usecases
 from app.usecases import tokens as tokens_usecases
 from app.usecases import cryptography as cryptography_usecases
 from app.usecases import geolocation as geolocation_usecases
-from app.usecases import logging as logging_usecases
 from app.usecases import channels as channels_usecases
 from app.usecases import streams as streams_usecases
+from app.usecases import rate_limits as rate_limits_usecases
+from app.usecases import restarts as restarts_usecases
 from app.common import serial
 from app.common import logger
 from app.common import settings
 from app.models.privileges import Privileges
+from app.models.login_data import LoginData
+from app.models.bcrypt_pool import BcryptPoolFull
+from app.models.admission_limiter import AdmissionRejected
+from app.models.token import Token
+from app.models.user import User
 
 import time
 import re
@@ -29,6 +36,18 @@ CLIENT_REGEX = re.compile(
     r"(?P<stream>beta|cuttingedge|dev|tourney)?$",
 )
 
+SERVER_BUSY_RESPONSE = serial.write_account_id_packet(
+    -1
+) + serial.write_notification_packet(
+    "Akatsuki: The server is busy right now. Please try again shortly!"
+)
+
+RATE_LIMITED_RESPONSE = serial.write_account_id_packet(
+    -1
+) + serial.write_notification_packet(
+    "Akatsuki: Too many login attempts. Please wait a minute and try again!"
+)
+
 
 def success_response(content: bytes, token: str) -> Response:
     return Response(content=content, headers={"cho-token": token}, status_code=200)
@@ -38,23 +57,104 @@ def failure_response(content: bytes) -> Response:
     return Response(content=content, headers={"cho-token": "no"}, status_code=200)
 
 
+async def fetch_location(
+    ctx: Context,
+    user: User,
+    ip: str,
+) -> tuple[str, float, float]:
+    """Returns the country code, latitude and longitude to show for the user."""
+    if user.privileges & Privileges.USER_DONOR:
+        # if donor, use their website flag
+        country = await users_usecases.fetch_country(ctx, user.id)
+        return country, 0.0, 0.0
+
+    geolocation = geolocation_usecases.fetch_geolocation_from_ip(ctx, ip)
+    return (
+        geolocation["country_acronym"],
+        geolocation["latitude"],
+        geolocation["longitude"],
+    )
+
+
 async def handle_packet_request(request: Request, ctx: Context) -> Response:
-    token = await tokens_usecases.fetch_one(ctx, token_id=request.headers["osu-token"])
+    token = await tokens_usecases.fetch_session(
+        ctx,
+        token_id=request.headers["osu-token"],
+    )
     if token is None:
-        return success_response(b"", request.headers["osu-token"])
+        # most likely lost in a restart, so reconnect without a thundering herd
+        return success_response(
+            restarts_usecases.write_restart_packets(),
+            request.headers["osu-token"],
+        )
+
+    tokens_usecases.update_ping_time(ctx, token.token_id)
 
     packet_data = await tokens_usecases.dequeue(ctx, token.token_id)
     return success_response(packet_data, token.token_id)
 
 
-@router.post("/")
-async def bancho_endpoint(request: Request, ctx: Context = Depends()):
-    request_body = await request.body()
+async def check_account_timers(ctx: Context, user: User, token: Token) -> bytes:
+    """Returns notices for pending freeze and donor timers, which the scheduler
+    applies once they lapse."""
+    response_data = bytearray()
 
-    if "osu-token" in request.headers:
-        return await handle_packet_request(request, ctx)
+    current_time = int(time.time())
 
-    login_data = login_usecases.parse_login_data(request_body)
+    if user.frozen == 1 or user.frozen > current_time:
+        # warn them, time is not over yet
+        if user.frozen == 1:  # the scheduler is about to start the timer
+            time_left = users_usecases.FREEZE_DURATION
+        else:
+            time_left = user.frozen - current_time
+
+        freeze_str = (
+            f" as a result of:\n\n{user.freeze_reason}\n" if user.freeze_reason else ""
+        )
+
+        message = "\n".join(
+            [
+                f"Your account has been frozen by an administrator{freeze_str}",
+                "This is not a restriction, but will lead to one if ignored.",
+                "You are required to submit a liveplay using the (specified criteria)[https://pastebin.com/BwcXp6Cr]",
+                "Please remember we are not stupid - we have done plenty of these before and have heard every excuse in the book; if you are breaking rules, your best bet would be to admit to a staff member, lying will only end up digging your grave deeper.",
+                "-------------",
+                "If you have any questions or are ready to liveplay, please contact an (Akatsuki Administrator)[https://akatsuki.pw/team] {ingame, (Discord)[https://akatsuki.pw/discord], etc.}",
+                f"Time until account restriction: {timedelta(seconds=time_left)}.",
+            ],
+        )
+
+        bot = await users_usecases.fetch_one(ctx, id=999)
+        assert bot is not None
+
+        response_data += serial.write_send_message_packet(
+            bot.username,
+            message,
+            token.username,
+            bot.id,
+        )
+
+    if user.privileges & Privileges.USER_DONOR:
+        has_premium = user.privileges & Privileges.USER_PREMIUM
+        role_name = "premium" if has_premium else "supporter"
+
+        if 0 < user.donor_expire - current_time <= 86_400 * 7:
+            # <= 7 days left, notify them
+            expires_in = timedelta(seconds=user.donor_expire - current_time)
+
+            response_data += serial.write_notification_packet(
+                f"Your {role_name} tag will expire in {str(expires_in):0>8}",
+            )
+
+    return bytes(response_data)
+
+
+async def handle_login_request(
+    login_data: LoginData,
+    ip: str,
+    background_tasks: BackgroundTasks,
+    ctx: Context,
+) -> Response:
     user = await users_usecases.fetch_one(ctx, username=login_data.username)
     if user is None:
         return failure_response(
@@ -73,11 +173,20 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
             )
         )
 
-    correct_password = await cryptography_usecases.verify_bcrypt_password(
-        ctx,
-        password_md5=login_data.password_md5,
-        bcrypt_hash=user.password_md5,
-    )
+    try:
+        correct_password = await cryptography_usecases.verify_bcrypt_password(
+            ctx,
+            password_md5=login_data.password_md5,
+            bcrypt_hash=user.password_md5,
+        )
+    except BcryptPoolFull:
+        logger.warning(
+            "Denied login while bcrypt pool is full",
+            username=user.username,
+            pending=ctx.bcrypt_pool.pending,
+            rejected=ctx.bcrypt_pool.rejected,
+        )
+        return failure_response(SERVER_BUSY_RESPONSE)
     if not correct_password:
         return failure_response(
             serial.write_account_id_packet(-1)
@@ -152,35 +261,35 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
             )
         )
 
-    ip = geolocation_usecases.retrieve_ip_from_headers(request.headers) or "some_ip"
-    if ip is None:
-        logger.warning("Denied login from unknown IP", username=user.username)
-        return failure_response(
-            serial.write_account_id_packet(-1)
-            + serial.write_notification_packet(
-                "Akatsuki: Something went wrong during your login attempt... Please try again!"
-            )
-        )
-
     # TODO: hardware logging
     first_login = pending_verification
 
-    await users_usecases.log_ip(ctx, user.id, ip)
+    background_tasks.add_task(
+        login_usecases.run_side_effect,
+        ctx,
+        "ip_log",
+        users_usecases.log_ip,
+        ctx,
+        user.id,
+        ip,
+    )
+
+    country, latitude, longitude = await fetch_location(ctx, user, ip)
 
     using_tournament_client = osu_version_regex["stream"] == "tourney"
-    async with await ctx.lock_manager.lock("akatsuki:locks:tokens"):
-        if not using_tournament_client:
-            # check if user is already logged in somewhere else
-            # if so, send failure
-            connected_clients = await tokens_usecases.fetch_all(ctx, user_id=user.id)
-            if connected_clients:
-                return failure_response(
-                    serial.write_account_id_packet(-1)
-                    + serial.write_notification_packet(
-                        "Akatsuki: You are already logged in somewhere else!"
-                    )
+    token_id = tokens_usecases.generate_token_id()
+    if not using_tournament_client:
+        # check if user is already logged in somewhere else
+        # if so, send failure
+        if not await tokens_usecases.claim_session(ctx, user.id, token_id):
+            return failure_response(
+                serial.write_account_id_packet(-1)
+                + serial.write_notification_packet(
+                    "Akatsuki: You are already logged in somewhere else!"
                 )
+            )
 
+    try:
         token = await tokens_usecases.create_one(
             ctx,
             user.id,
@@ -192,146 +301,49 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
             login_data.utc_offset,
             using_tournament_client,
             login_data.pm_private,
+            country=users_usecases.fetch_country_id(country),
+            latitude=latitude,
+            longitude=longitude,
+            token_id=token_id,
         )
 
+        if not using_tournament_client:
+            await tokens_usecases.confirm_session(ctx, user.id)
+    except Exception:
+        # a pending claim would lock the user out until it times out
+        if not using_tournament_client:
+            await tokens_usecases.release_session(ctx, user.id, token_id)
+        raise
+
     logger.info("Successful login", username=user.username, ip=ip)
 
-    await tokens_usecases.check_restricted(
-        ctx,
-        token.token_id,
-        token.user_id,
-        token.privileges,
+    login_steps = await login_usecases.gather_steps(
+        account_timers=check_account_timers(ctx, user, token),
+        channels=tokens_usecases.join_channels(
+            ctx,
+            token.token_id,
+            settings.AUTO_JOIN_CHANNELS,
+            auto_join=True,
+        ),
+        channel_info=channels_usecases.fetch_channel_info_packets(ctx),
+        friends=users_usecases.fetch_friends(ctx, user.id),
+        presences=tokens_usecases.fetch_presence_snapshot(ctx),
     )
 
-    response_data = bytearray()
-
-    current_time = int(time.time())
-
-    if user.frozen:
-        if user.frozen == 1:
-            user.frozen = await users_usecases.begin_freeze_timer(ctx, user.id)
-
-        freeze_str = (
-            f" as a result of:\n\n{user.freeze_reason}\n" if user.freeze_reason else ""
-        )
-
-        if user.frozen > current_time:
-            # warn them, time is not over yet
-
-            message = "\n".join(
-                [
-                    f"Your account has been frozen by an administrator{freeze_str}",
-                    "This is not a restriction, but will lead to one if ignored.",
-                    "You are required to submit a liveplay using the (specified criteria)[https://pastebin.com/BwcXp6Cr]",
-                    "Please remember we are not stupid - we have done plenty of these before and have heard every excuse in the book; if you are breaking rules, your best bet would be to admit to a staff member, lying will only end up digging your grave deeper.",
-                    "-------------",
-                    "If you have any questions or are ready to liveplay, please contact an (Akatsuki Administrator)[https://akatsuki.pw/team] {ingame, (Discord)[https://akatsuki.pw/discord], etc.}",
-                    f"Time until account restriction: {timedelta(seconds=user.frozen - current_time)}.",
-                ],
-            )
-
-            bot = await users_usecases.fetch_one(ctx, id=999)
-            assert bot is not None
-
-            response_data += serial.write_send_message_packet(
-                bot.username,
-                message,
-                token.username,
-                bot.id,
-            )
-        else:
-            # timer is up, restrict !!!!
-
-            user.privileges = token.privileges = await users_usecases.restrict(
-                ctx,
-                user.id,
-                user.privileges,
-            )
-
-            await users_usecases.unfreeze(ctx, user.id, log=False)
-            user.frozen = 0
-
-            notification = "\n".join(
-                [
-                    "Your account has been automatically restricted due to an account freeze being left unhandled for over 7 days.",
-                    "You are still welcome to liveplay, although your account will remain in restricted mode unless this is handled.",
-                ]
-            )
-            response_data += serial.write_notification_packet(notification)
-
-            await logging_usecases.rap(
-                ctx,
-                user.id,
-                "has been automatically restricted due to a pending freeze.",
-            )
-
-            await logging_usecases.anticheat(
-                f"[{user.username}](https://akatsuki.pw/u/{user.id}) has been automatically restricted due to a pending freeze.",
-                "ac_general",
-            )
-
-    if user.privileges & Privileges.USER_DONOR:
-        has_premium = user.privileges & Privileges.USER_PREMIUM
-        role_name = "premium" if has_premium else "supporter"
-
-        if current_time >= user.donor_expire:
-            user.privileges = (
-                token.privileges
-            ) = await users_usecases.revoke_supporter_privileges(
-                ctx,
-                user.id,
-                user.privileges,
-            )
-
-            response_data += serial.write_notification_packet(
-                "\n".join(
-                    [
-                        f"Your {role_name} tag has expired.",
-                        "Whether you continue to support us or not, we'd like to thank you "
-                        "to the moon and back for your support so far - it really means everything to us.",
-                        "- cmyui, and the Akatsuki Team",
-                    ],
-                ),
-            )
-        elif user.donor_expire - current_time <= 86_400 * 7:
-            # <= 7 days left, notify them
-            expires_in = timedelta(seconds=user.donor_expire - current_time)
-
-            response_data += serial.write_notification_packet(
-                f"Your {role_name} tag will expire in {str(expires_in):0>8}",
-            )
+    response_data = bytearray(login_steps["account_timers"])
 
     silence_seconds = tokens_usecases.get_remaining_silence_seconds(
         token.silence_end_time
     )
     user_restricted = users_usecases.is_restricted(token.privileges)
     user_gmt = users_usecases.is_staff(token.privileges)
-    user_tournament = users_usecases.is_tournament_staff(token.privileges)
-
-    if token.privileges & Privileges.USER_DONOR:
-        # if donor, use their website flag
-        country = await users_usecases.fetch_country(ctx, user.id)
-        longitude = 0.0
-        latitude = 0.0
-    else:
-        geolocation = geolocation_usecases.fetch_geolocation_from_ip(ctx, ip)
-
-        country = geolocation["country_acronym"]
-        longitude = geolocation["longitude"]
-        latitude = geolocation["latitude"]
-
-    token.country = users_usecases.fetch_country_id(country)
-    token.longitude = longitude
-    token.latitude = latitude
-
-    # TODO: restart check?
 
     if settings.LOGIN_NOTIFICATION:
         response_data += serial.write_notification_packet(settings.LOGIN_NOTIFICATION)
 
     if settings.MAINTENANCE_MODE:
         if not user_gmt:
-            await tokens_usecases.delete_one(ctx, token.token_id)
+            await tokens_usecases.logout(ctx, token.token_id)
             return failure_response(
                 response_data
                 + serial.write_account_id_packet(-1)
@@ -345,34 +357,27 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
                 "Type '!system maintenance off' in chat to disable maintenance mode."
             )
 
+    # queued only once the login can no longer be rejected, as it needs the token
+    background_tasks.add_task(
+        login_usecases.run_side_effect,
+        ctx,
+        "restriction_message",
+        tokens_usecases.check_restricted,
+        ctx,
+        token.token_id,
+        token.user_id,
+        token.privileges,
+    )
+
     response_data += serial.write_protocol_version_packet(19)
     response_data += serial.write_account_id_packet(user.id)
     response_data += serial.write_silence_end_packet(silence_seconds)
 
-    client_privileges = 1
-    if not user_restricted:
-        # "supporter"
-        client_privileges |= 4
-
-    if user_gmt:
-        # "BAT"
-        client_privileges |= 2
-
-    if user_tournament:
-        client_privileges |= 32
+    client_privileges = tokens_usecases.get_client_privileges(token.privileges)
+    presence_packet = tokens_usecases.write_presence_packet(token)
 
     response_data += serial.write_privileges_packet(client_privileges)
-    response_data += serial.write_user_presence_packet(
-        user.id,
-        user.username,
-        token.utc_offset,
-        token.country,
-        client_privileges,
-        token.mode,
-        token.latitude,
-        token.longitude,
-        token.global_rank,
-    )
+    response_data += presence_packet
     response_data += serial.write_user_stats_packet(
         user.id,
         token.action_id,
@@ -389,23 +394,8 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
         token.pp,
     )
 
-    await tokens_usecases.join_channel(ctx, token.token_id, channel_name="#osu")
-    await tokens_usecases.join_channel(ctx, token.token_id, channel_name="#announce")
-
-    # join default channels
-    for channel in await channels_usecases.fetch_all(ctx):
-        if channel.public_read and not channel.instance:
-            client_count = len(
-                await streams_usecases.fetch_clients(ctx, f"chat/{channel.name}")
-            )
-            response_data += serial.write_channel_info_packet(
-                channel.name, channel.description, client_count
-            )
-
-    response_data += serial.write_channel_info_end_packet()
-
-    friends = await users_usecases.fetch_friends(ctx, user.id)
-    response_data += serial.write_friends_list_packet(friends)
+    response_data += login_steps["channel_info"]
+    response_data += serial.write_friends_list_packet(login_steps["friends"])
 
     if settings.MAIN_MENU_ICON_URL and settings.MAIN_MENU_ON_CLICK_URL:
         response_data += serial.write_main_menu_icon_packet(
@@ -413,52 +403,66 @@ async def bancho_endpoint(request: Request, ctx: Context = Depends()):
             settings.MAIN_MENU_ON_CLICK_URL,
         )
 
-    async with await ctx.lock_manager.lock("akatsuki:locks:tokens"):
-        for user_token in await tokens_usecases.fetch_all(ctx):
-            if users_usecases.is_restricted(user_token.privileges):
-                continue
-
-            client_privileges = 1 | 4
-
-            user_token_gmt = users_usecases.is_staff(user_token.privileges)
-            user_token_tournament = users_usecases.is_tournament_staff(
-                user_token.privileges
-            )
-
-            if user_token_gmt:
-                # "BAT"
-                client_privileges |= 2
-
-            if user_token_tournament:
-                client_privileges |= 32
-
-            response_data += serial.write_user_presence_packet(
-                user_token.user_id,
-                user_token.username,
-                user_token.utc_offset,
-                user_token.country,
-                client_privileges,
-                user_token.mode,
-                user_token.latitude,
-                user_token.longitude,
-                user_token.global_rank,
-            )
+    response_data += login_steps["presences"]
 
     if not user_restricted:
-        await streams_usecases.broadcast(
+        background_tasks.add_task(
+            login_usecases.run_side_effect,
+            ctx,
+            "presence_broadcast",
+            streams_usecases.broadcast,
             ctx,
             "main",
-            serial.write_user_presence_packet(
-                user.id,
-                user.username,
-                token.utc_offset,
-                token.country,
-                client_privileges,
-                token.mode,
-                token.latitude,
-                token.longitude,
-                token.global_rank,
-            ),
+            presence_packet,
         )
 
     return success_response(bytes(response_data), token.token_id)
+
+
+@router.post("/")
+async def bancho_endpoint(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    ctx: Context = Depends(),
+):
+    request_body = await request.body()
+
+    # polls skip admission, so connected players stay responsive during login storms
+    if "osu-token" in request.headers:
+        return await handle_packet_request(request, ctx)
+
+    login_data = login_usecases.parse_login_data(request_body)
+
+    ip = geolocation_usecases.retrieve_ip_from_headers(request.headers)
+    if ip is None and request.client is not None:
+        # not behind a proxy, so the peer address is the client's
+        ip = request.client.host
+
+    # checked before admission, so attempt floods never take a login slot
+    if not await rate_limits_usecases.allow_login_attempt(
+        ctx,
+        ip,
+        login_data.username,
+    ):
+        logger.warning(
+            "Rate limited login attempt",
+            username=login_data.username,
+            ip=ip,
+        )
+        return failure_response(RATE_LIMITED_RESPONSE)
+
+    try:
+        async with ctx.login_admission.admit(settings.LOGIN_QUEUE_TIMEOUT):
+            return await handle_login_request(
+                login_data,
+                ip or "some_ip",
+                background_tasks,
+                ctx,
+            )
+    except AdmissionRejected:
+        logger.warning(
+            "Shed login under load",
+            queued=ctx.login_admission.queued,
+            rejected=ctx.login_admission.rejected,
+        )
+        return failure_response(SERVER_BUSY_RESPONSE)
@@ -1,6 +1,12 @@
 from app.models.redis_cache import RedisCache
+from app.models.ping_buffer import PingBuffer
+from app.models.channel_registry import ChannelRegistry
+from app.models.bcrypt_pool import BcryptPool
+from app.models.admission_limiter import AdmissionLimiter
+from app.models.presence_snapshot import PresenceSnapshot
 
 from fastapi import Request
+from asyncio import Semaphore
 from asyncql import Database
 from aioredis import Redis
 from aioredlock import Aioredlock
@@ -20,9 +26,13 @@ class Context:
         return self.request.app.state.redis
 
     @property
-    def bcrypt_cache(self) -> RedisCache[str]:
+    def bcrypt_cache(self) -> RedisCache[bool]:
         return self.request.app.state.bcrypt_cache
 
+    @property
+    def bcrypt_pool(self) -> BcryptPool:
+        return self.request.app.state.bcrypt_pool
+
     @property
     def lock_manager(self) -> Aioredlock:
         return self.request.app.state.lock_manager
@@ -30,3 +40,23 @@ class Context:
     @property
     def geolocation_reader(self) -> Reader:
         return self.request.app.state.geolocation_reader
+
+    @property
+    def ping_buffer(self) -> PingBuffer:
+        return self.request.app.state.ping_buffer
+
+    @property
+    def channel_registry(self) -> ChannelRegistry:
+        return self.request.app.state.channel_registry
+
+    @property
+    def side_effect_limiter(self) -> Semaphore:
+        return self.request.app.state.side_effect_limiter
+
+    @property
+    def login_admission(self) -> AdmissionLimiter:
+        return self.request.app.state.login_admission
+
+    @property
+    def presence_snapshot(self) -> PresenceSnapshot:
+        return self.request.app.state.presence_snapshot
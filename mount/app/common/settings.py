@@ -1,4 +1,5 @@
 from dotenv import load_dotenv
+from uuid import uuid4
 
 import os
 
@@ -27,3 +28,70 @@ MAIN_MENU_ICON_URL = os.environ.get("MAIN_MENU_ICON_URL", None)
 MAIN_MENU_ON_CLICK_URL = os.environ.get("MAIN_MENU_ON_CLICK_URL", None)
 
 GEOLOCATION_DB_PATH = os.environ["GEOLOCATION_DB_PATH"]
+
+PING_TIMEOUT = int(os.environ.get("PING_TIMEOUT", 120))
+# pings are written behind, so they may be up to this stale (must be < PING_TIMEOUT)
+PING_FLUSH_INTERVAL = int(os.environ.get("PING_FLUSH_INTERVAL", 5))
+TOKEN_REAPER_INTERVAL = int(os.environ.get("TOKEN_REAPER_INTERVAL", 10))
+TOKEN_REAPER_BATCH_SIZE = int(os.environ.get("TOKEN_REAPER_BATCH_SIZE", 100))
+
+# wipe leftover sessions on startup; disable when instances share a database
+CLEAR_EPHEMERAL_STATE = os.environ.get("CLEAR_EPHEMERAL_STATE", "true") == "true"
+
+# where stream membership is kept, either "redis" or "mysql"
+STREAM_BACKEND = os.environ.get("STREAM_BACKEND", "redis")
+
+AUTO_JOIN_CHANNELS = os.environ.get("AUTO_JOIN_CHANNELS", "#osu,#announce").split(",")
+
+# how stale the cached channel list's member counts may get, in milliseconds
+CHANNEL_INFO_REFRESH_INTERVAL = int(
+    os.environ.get("CHANNEL_INFO_REFRESH_INTERVAL", 5000),
+)
+
+# how often workers check whether channels changed, in milliseconds
+CHANNEL_REGISTRY_CHECK_INTERVAL = int(
+    os.environ.get("CHANNEL_REGISTRY_CHECK_INTERVAL", 1000),
+)
+
+# how many independent login steps may run at once
+LOGIN_STEP_CONCURRENCY = int(os.environ.get("LOGIN_STEP_CONCURRENCY", 8))
+
+# how many post-response side effects (logs, webhooks, broadcasts) may run at once
+SIDE_EFFECT_CONCURRENCY = int(os.environ.get("SIDE_EFFECT_CONCURRENCY", 32))
+
+# how long a login may hold a session claim before creating its token, in seconds
+SESSION_CLAIM_TIMEOUT = int(os.environ.get("SESSION_CLAIM_TIMEOUT", 30))
+
+# threads verifying bcrypt passwords, and how many checks may wait for one
+BCRYPT_WORKERS = int(os.environ.get("BCRYPT_WORKERS", os.cpu_count() or 1))
+BCRYPT_MAX_PENDING = int(os.environ.get("BCRYPT_MAX_PENDING", 64))
+
+# how long verified passwords stay cached, in seconds, and how many stay in memory
+BCRYPT_CACHE_TTL = int(os.environ.get("BCRYPT_CACHE_TTL", 86400))
+BCRYPT_CACHE_LOCAL_SIZE = int(os.environ.get("BCRYPT_CACHE_LOCAL_SIZE", 4096))
+
+# logins processed at once, how many more may wait, and for how long in seconds
+LOGIN_CONCURRENCY = int(os.environ.get("LOGIN_CONCURRENCY", 32))
+LOGIN_QUEUE_SIZE = int(os.environ.get("LOGIN_QUEUE_SIZE", 256))
+LOGIN_QUEUE_TIMEOUT = float(os.environ.get("LOGIN_QUEUE_TIMEOUT", 5))
+
+# login attempts allowed per ip and per username within the window, in seconds
+LOGIN_RATE_LIMIT_WINDOW = int(os.environ.get("LOGIN_RATE_LIMIT_WINDOW", 60))
+LOGIN_IP_RATE_LIMIT = int(os.environ.get("LOGIN_IP_RATE_LIMIT", 30))
+LOGIN_USERNAME_RATE_LIMIT = int(os.environ.get("LOGIN_USERNAME_RATE_LIMIT", 10))
+
+# how stale the online presences sent on login may get, in milliseconds
+PRESENCE_SNAPSHOT_INTERVAL = int(os.environ.get("PRESENCE_SNAPSHOT_INTERVAL", 1000))
+
+# how often due freezes and donor expiries are processed, and re-read from the database, in seconds
+SCHEDULER_INTERVAL = int(os.environ.get("SCHEDULER_INTERVAL", 5))
+SCHEDULER_RESEED_INTERVAL = int(os.environ.get("SCHEDULER_RESEED_INTERVAL", 300))
+SCHEDULER_BATCH_SIZE = int(os.environ.get("SCHEDULER_BATCH_SIZE", 100))
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", 4))
+
+# log out this instance's clients on shutdown, so they reconnect spread over a window in seconds
+GRACEFUL_RESTART = os.environ.get("GRACEFUL_RESTART", "true") == "true"
+RESTART_WINDOW = int(os.environ.get("RESTART_WINDOW", 30))
+
+# tags the tokens this instance creates; workers sharing an id restart together
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or str(uuid4())
@@ -0,0 +1,11 @@
+from typing import Any
+
+
+def build_filters(**filters: Any) -> tuple[str, dict[str, Any]]:
+    # only filter on given values, as COALESCE(:x, x) prevents index usage
+    params = {key: value for key, value in filters.items() if value is not None}
+    if not params:
+        return "", params
+
+    conditions = " AND ".join(f"{key} = :{key}" for key in params)
+    return f"WHERE {conditions}", params
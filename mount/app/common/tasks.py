@@ -0,0 +1,14 @@
+from typing import Any
+from typing import Coroutine
+from typing import TypeVar
+
+import asyncio
+import contextvars
+
+T = TypeVar("T")
+
+
+def create_isolated_task(coro: Coroutine[Any, Any, T]) -> asyncio.Task[T]:
+    # a fresh context means the task checks out its own database connection,
+    # rather than sharing the caller's one, which can't run queries concurrently
+    return contextvars.Context().run(asyncio.create_task, coro)
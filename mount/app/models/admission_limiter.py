@@ -0,0 +1,43 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import asyncio
+
+
+class AdmissionRejected(Exception):
+    ...
+
+
+class AdmissionLimiter:
+    """Bounds concurrent work, queueing up to `max_queued` callers behind it."""
+
+    def __init__(self, max_concurrent: int, max_queued: int) -> None:
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_queued = max_queued
+
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def admit(self, timeout: float) -> AsyncIterator[None]:
+        """Raises `AdmissionRejected` if the queue is full, or the wait for a slot
+        exceeds `timeout` seconds."""
+        if self.semaphore.locked() and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise AdmissionRejected()
+
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise AdmissionRejected() from None
+        finally:
+            self.queued -= 1
+
+        self.admitted += 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import time
+import bcrypt
+
+
+class BcryptPoolFull(Exception):
+    ...
+
+
+class BcryptPool:
+    """A dedicated executor for bcrypt checks, which rejects work once too much is
+    waiting rather than queueing it without bound."""
+
+    def __init__(self, max_workers: int, max_pending: int) -> None:
+        # bcrypt releases the gil while hashing, so threads use every core
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="bcrypt",
+        )
+        self.max_pending = max_pending
+
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+
+    async def checkpw(self, password: bytes, hashed_password: bytes) -> bool:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise BcryptPoolFull()
+
+        self.pending += 1
+        start_time = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(
+                self.executor,
+                bcrypt.checkpw,
+                password,
+                hashed_password,
+            )
+        finally:
+            self.pending -= 1
+
+        self.completed += 1
+        self.total_latency += time.perf_counter() - start_time
+        return result
+
+    @property
+    def average_latency_ms(self) -> float:
+        if not self.completed:
+            return 0.0
+
+        return round(self.total_latency / self.completed * 1000, 2)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
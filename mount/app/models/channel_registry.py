@@ -0,0 +1,20 @@
+from app.models.channel import Channel
+
+
+class ChannelRegistry:
+    def __init__(self) -> None:
+        self.channels: dict[str, Channel] = {}
+        self.bits: dict[str, int] = {}
+        self.permission_masks: dict[int, tuple[int, int]] = {}
+        self.version: int | None = None
+        self.checked_at = 0.0
+
+    def load(self, channels: list[Channel], version: int) -> None:
+        self.channels = {channel.name: channel for channel in channels}
+        self.bits = {name: 1 << idx for idx, name in enumerate(sorted(self.channels))}
+        self.permission_masks = {}
+        self.version = version
+
+    def invalidate(self) -> None:
+        self.version = None
+        self.checked_at = 0.0
@@ -0,0 +1,10 @@
+class PingBuffer:
+    def __init__(self) -> None:
+        self.ping_times: dict[str, int] = {}
+
+    def record(self, token_id: str, ping_time: int) -> None:
+        self.ping_times[token_id] = ping_time
+
+    def drain(self) -> dict[str, int]:
+        ping_times, self.ping_times = self.ping_times, {}
+        return ping_times
@@ -0,0 +1,8 @@
+class PresenceSnapshot:
+    def __init__(self) -> None:
+        self.packets = b""
+        self.built_at = 0.0
+
+    def load(self, packets: bytes, built_at: float) -> None:
+        self.packets = packets
+        self.built_at = built_at
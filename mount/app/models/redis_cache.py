@@ -1,24 +1,125 @@
+from collections import OrderedDict
+from typing import Awaitable
+from typing import Callable
 from typing import Generic
 from typing import TypeVar
 from aioredis import Redis
 
+import asyncio
+import time
 import orjson
 
 T = TypeVar("T")
 
 
 class RedisCache(Generic[T]):
-    def __init__(self, connection: Redis, identifier: str) -> None:
+    """Caches values in redis under `{identifier}:{key}`, optionally in front of
+    an in-process LRU of up to `max_local_size` entries."""
+
+    def __init__(
+        self,
+        connection: Redis,
+        identifier: str,
+        ttl: int | None = None,
+        max_local_size: int = 0,
+    ) -> None:
         self.connection = connection
         self.identifier = identifier
+        self.ttl = ttl
+        self.max_local_size = max_local_size
+
+        self.local: OrderedDict[str, tuple[T, float | None]] = OrderedDict()
+        self.in_flight: dict[str, asyncio.Future[T | None]] = {}
+
+        self.local_hits = 0
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, key: str) -> str:
+        return f"{self.identifier}:{key}"
+
+    def get_local(self, key: str) -> T | None:
+        entry = self.local.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            del self.local[key]
+            return None
+
+        self.local.move_to_end(key)
+        return value
+
+    def set_local(self, key: str, value: T) -> None:
+        if self.max_local_size <= 0:
+            return
+
+        expires_at = time.time() + self.ttl if self.ttl is not None else None
+        self.local[key] = (value, expires_at)
+        self.local.move_to_end(key)
+
+        while len(self.local) > self.max_local_size:
+            self.local.popitem(last=False)
 
     async def get(self, key: str) -> T | None:
-        value = await self.connection.hget(self.identifier, key)
-        if value is None:
+        value = self.get_local(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+
+        raw_value = await self.connection.get(self.make_key(key))
+        if raw_value is None:
+            self.misses += 1
             return None
 
-        return orjson.loads(value)
+        self.hits += 1
+
+        value = orjson.loads(raw_value)
+        self.set_local(key, value)
+        return value
 
     async def set(self, key: str, value: T) -> None:
         raw_value = orjson.dumps(value)
-        await self.connection.hset(self.identifier, key, raw_value)
+        await self.connection.set(self.make_key(key), raw_value, ex=self.ttl)
+
+        self.set_local(key, value)
+
+    async def delete(self, key: str) -> None:
+        self.local.pop(key, None)
+        await self.connection.delete(self.make_key(key))
+
+    async def get_or_set(
+        self,
+        key: str,
+        func: Callable[[], Awaitable[T | None]],
+    ) -> T | None:
+        """Concurrent misses for the same key share a single call to `func`.
+        `None` results are returned but not stored."""
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        in_flight = self.in_flight.get(key)
+        if in_flight is not None:
+            return await asyncio.shield(in_flight)
+
+        future: asyncio.Future[T | None] = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            value = await func()
+            if value is not None:
+                await self.set(key, value)
+        except Exception as exc:
+            future.set_exception(exc)
+            # don't warn about an exception no other caller waited for
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            del self.in_flight[key]
@@ -26,6 +26,7 @@ class Token(BaseModel):
     last_np_accuracy: float | None
     silence_end_time: int
     protocol_version: int
+    instance_id: str
     spam_rate: int
     action_id: int
     action_text: str
@@ -41,3 +42,22 @@ class Token(BaseModel):
     total_score: int
     global_rank: int
     pp: int
+
+
+class TokenSession(BaseModel):
+    token_id: str
+    user_id: int
+    username: str
+    privileges: int
+    whitelist: int
+    login_time: int
+    utc_offset: int
+    tournament: bool
+    block_non_friends_dm: bool
+    latitude: float
+    longitude: float
+    ip: str
+    country: int
+    silence_end_time: int
+    protocol_version: int
+    instance_id: str
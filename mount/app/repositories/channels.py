@@ -12,7 +12,7 @@ class ChannelsRepository:
 
     async def fetch_one(
         self,
-        channel_name: str | None = None,
+        channel_name: str,
     ) -> dict[str, Any] | None:
         query = f"""\
             SELECT
@@ -20,7 +20,7 @@ class ChannelsRepository:
             FROM
               channels
             WHERE
-              name = COALESCE(:channel_name, name)
+              name = :channel_name
         """
         params = {
             "channel_name": channel_name,
@@ -78,6 +78,7 @@ class ChannelsRepository:
         """
         params = {
             "channel_name": channel_name,
+            **updates,
         }
 
         await self.ctx.database.execute(query, params)
@@ -91,64 +92,10 @@ class ChannelsRepository:
             DELETE FROM
               channels
             WHERE
-              channel_name = :channel_name
-        """
-        params = {
-            "channel_name": channel_name,
-        }
-
-        await self.ctx.database.execute(query, params)
-
-    async def fetch_clients(
-        self,
-        token_id: str | None = None,
-        channel_name: str | None = None,
-    ) -> list[dict[str, Any]]:
-        query = f"""\
-            SELECT
-              token_id, channel_name
-            FROM
-              channel_tokens
-            WHERE
-              channel_name = COALESCE(:channel_name, channel_name)
-              AND token_id = COALESCE(:token_id, token_id)
-        """
-        params = {
-            "channel_name": channel_name,
-            "token_id": token_id,
-        }
-
-        clients = await self.ctx.database.fetch_all(query, params)
-        return clients
-
-    async def add_client(
-        self,
-        channel_name: str,
-        token_id: str,
-    ) -> None:
-        query = f"""\
-            INSERT INTO channel_tokens (channel_name, token_id)
-            VALUES (:channel_name, :token_id)
-        """
-        params = {"channel_name": channel_name, "token_id": token_id}
-
-        await self.ctx.database.execute(query, params)
-
-    async def remove_client(
-        self,
-        channel_name: str,
-        token_id: str,
-    ) -> None:
-        query = """\
-            DELETE FROM 
-              channel_tokens
-            WHERE
-              channel_name = :channel_name 
-              AND token_id = :token_id
+              name = :channel_name
         """
         params = {
             "channel_name": channel_name,
-            "token_id": token_id,
         }
 
         await self.ctx.database.execute(query, params)
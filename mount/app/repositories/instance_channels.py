@@ -0,0 +1,50 @@
+from app.common.context import Context
+from typing import Any
+
+import orjson
+
+
+class InstanceChannelsRepository:
+    """Keeps short-lived #spect_ and #multi_ channels in a redis hash."""
+
+    def __init__(self, ctx: Context) -> None:
+        self.ctx = ctx
+
+        self.KEY = "akatsuki:channels:instances"
+
+    async def fetch_one(
+        self,
+        channel_name: str,
+    ) -> dict[str, Any] | None:
+        channel = await self.ctx.redis.hget(self.KEY, channel_name)
+        if channel is None:
+            return None
+
+        return orjson.loads(channel)
+
+    async def fetch_all(self) -> list[dict[str, Any]]:
+        channels = await self.ctx.redis.hvals(self.KEY)
+        return [orjson.loads(channel) for channel in channels]
+
+    async def create_one(
+        self,
+        channel_name: str,
+        description: str,
+        public_read: bool,
+        public_write: bool,
+        moderated: bool,
+    ) -> dict[str, Any]:
+        channel = {
+            "name": channel_name,
+            "description": description,
+            "public_read": public_read,
+            "public_write": public_write,
+            "moderated": moderated,
+            "instance": True,
+        }
+
+        await self.ctx.redis.hset(self.KEY, channel_name, orjson.dumps(channel))
+        return channel
+
+    async def delete_one(self, channel_name: str) -> None:
+        await self.ctx.redis.hdel(self.KEY, channel_name)
@@ -0,0 +1,48 @@
+from app.common.context import Context
+from uuid import uuid4
+
+import time
+
+# KEYS[n] - attempt log key
+# ARGV[1] - current time, in milliseconds
+# ARGV[2] - window, in milliseconds
+# ARGV[2 + n] - attempt limit for KEYS[n]
+# ARGV[#KEYS + 3] - unique attempt id
+RECORD_ATTEMPT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+
+for idx, key in ipairs(KEYS) do
+    redis.call("ZREMRANGEBYSCORE", key, "-inf", now - window)
+    if redis.call("ZCARD", key) >= tonumber(ARGV[2 + idx]) then
+        return 0
+    end
+end
+
+for _, key in ipairs(KEYS) do
+    redis.call("ZADD", key, now, ARGV[#KEYS + 3])
+    redis.call("PEXPIRE", key, window)
+end
+return 1
+"""
+
+
+class RateLimitsRepository:
+    """Sliding window attempt logs, kept as redis sorted sets."""
+
+    def __init__(self, ctx: Context) -> None:
+        self.ctx = ctx
+
+    async def record_attempt(self, limits: dict[str, int], window: int) -> bool:
+        """Records an attempt against every key, unless any key is at its limit."""
+        record_attempt_script = self.ctx.redis.register_script(RECORD_ATTEMPT_SCRIPT)
+        recorded = await record_attempt_script(
+            keys=list(limits),
+            args=[
+                int(time.time() * 1000),
+                window,
+                *limits.values(),
+                str(uuid4()),
+            ],
+        )
+        return recorded == 1
@@ -0,0 +1,73 @@
+from app.common.context import Context
+from app.models.privileges import Privileges
+from typing import Any
+
+FREEZES_KEY = "akatsuki:schedules:freezes"
+DONOR_EXPIRIES_KEY = "akatsuki:schedules:donor_expiries"
+SEEDED_KEY = "akatsuki:schedules:seeded"
+
+
+class SchedulesRepository:
+    """Due queues of user ids, kept as redis sorted sets scored by due time."""
+
+    def __init__(self, ctx: Context) -> None:
+        self.ctx = ctx
+
+    async def fetch_frozen_users(self) -> list[dict[str, Any]]:
+        query = f"""\
+            SELECT id, frozen
+              FROM users
+            WHERE frozen != 0
+        """
+
+        users = await self.ctx.database.fetch_all(query)
+        return users
+
+    async def fetch_donors(self) -> list[dict[str, Any]]:
+        query = f"""\
+            SELECT id, donor_expire
+              FROM users
+            WHERE privileges & :donor != 0
+        """
+        params = {"donor": Privileges.USER_DONOR}
+
+        users = await self.ctx.database.fetch_all(query, params)
+        return users
+
+    async def claim_seed(self, interval: int) -> bool:
+        """Returns whether no other worker has seeded within the interval."""
+        claimed = await self.ctx.redis.set(SEEDED_KEY, 1, nx=True, px=interval)
+        return claimed is not None
+
+    async def schedule(self, key: str, due_times: dict[int, int]) -> None:
+        if not due_times:
+            return
+
+        await self.ctx.redis.zadd(key, due_times)
+
+    async def fetch_due(self, key: str, now: int, limit: int) -> list[int]:
+        user_ids = await self.ctx.redis.zrangebyscore(
+            key,
+            "-inf",
+            now,
+            start=0,
+            num=limit,
+        )
+        return [int(user_id) for user_id in user_ids]
+
+    async def claim(self, key: str, user_ids: list[int]) -> list[int]:
+        """Returns the user ids which no other worker claimed first."""
+        async with self.ctx.redis.pipeline() as pipe:
+            for user_id in user_ids:
+                pipe.zrem(key, user_id)
+
+            removed = await pipe.execute()
+
+        return [
+            user_id
+            for user_id, was_removed in zip(user_ids, removed)
+            if was_removed == 1
+        ]
+
+    async def count(self, key: str) -> int:
+        return await self.ctx.redis.zcard(key)
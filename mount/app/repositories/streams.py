@@ -1,6 +1,26 @@
 from app.common.context import Context
 from typing import Any
 
+# KEYS[1] - stream clients key
+# KEYS[2] - token streams key
+# ARGV[1] - token id
+# ARGV[2] - stream name
+ADD_CLIENT_SCRIPT = """
+local added = redis.call("SADD", KEYS[1], ARGV[1])
+redis.call("SADD", KEYS[2], ARGV[2])
+return {added, redis.call("SCARD", KEYS[1])}
+"""
+
+# KEYS[1] - stream clients key
+# KEYS[2] - token streams key
+# ARGV[1] - token id
+# ARGV[2] - stream name
+REMOVE_CLIENT_SCRIPT = """
+local removed = redis.call("SREM", KEYS[1], ARGV[1])
+redis.call("SREM", KEYS[2], ARGV[2])
+return {removed, redis.call("SCARD", KEYS[1])}
+"""
+
 
 class StreamsRepository:
     def __init__(self, ctx: Context) -> None:
@@ -18,7 +38,7 @@ class StreamsRepository:
             FROM
               streams
             WHERE
-              name = COALESCE(:stream_name, name)
+              name = :stream_name
         """
         params = {
             "stream_name": stream_name,
@@ -76,7 +96,7 @@ class StreamsRepository:
             DELETE FROM
               streams
             WHERE
-              stream_name = :stream_name
+              name = :stream_name
         """
         params = {
             "stream_name": stream_name,
@@ -94,7 +114,7 @@ class StreamsRepository:
             FROM
               stream_tokens
             WHERE
-              stream_name = COALESCE(:stream_name, stream_name)
+              stream_name = :stream_name
         """
         params = {
             "stream_name": stream_name,
@@ -103,29 +123,148 @@ class StreamsRepository:
         clients = await self.ctx.database.fetch_all(query, params)
         return clients
 
+    async def fetch_client_streams(
+        self,
+        token_id: str,
+    ) -> list[dict[str, Any]]:
+        query = f"""\
+            SELECT
+              stream_name
+            FROM
+              stream_tokens
+            WHERE
+              token_id = :token_id
+        """
+        params = {
+            "token_id": token_id,
+        }
+
+        streams = await self.ctx.database.fetch_all(query, params)
+        return streams
+
+    async def count_clients(
+        self,
+        stream_name: str,
+    ) -> int:
+        query = f"""\
+            SELECT
+              COUNT(*) AS client_count
+            FROM
+              stream_tokens
+            WHERE
+              stream_name = :stream_name
+        """
+        params = {
+            "stream_name": stream_name,
+        }
+
+        row = await self.ctx.database.fetch_one(query, params)
+        assert row is not None
+
+        return row["client_count"]
+
+    async def count_clients_many(
+        self,
+        stream_names: list[str],
+    ) -> list[int]:
+        if not stream_names:
+            return []
+
+        query = f"""\
+            SELECT
+              stream_name,
+              COUNT(*) AS client_count
+            FROM
+              stream_tokens
+            WHERE
+              stream_name IN :stream_names
+            GROUP BY
+              stream_name
+        """
+        params = {"stream_names": stream_names}
+
+        client_counts = {
+            row["stream_name"]: row["client_count"]
+            for row in await self.ctx.database.fetch_all(query, params)
+        }
+        return [client_counts.get(stream_name, 0) for stream_name in stream_names]
+
     async def add_client(
         self,
         stream_name: str,
         token_id: str,
-    ) -> None:
+    ) -> tuple[bool, int]:
         query = f"""\
-            INSERT INTO stream_tokens (stream_name, token_id)
+            INSERT IGNORE INTO stream_tokens (stream_name, token_id)
             VALUES (:stream_name, :token_id)
         """
         params = {"stream_name": stream_name, "token_id": token_id}
 
-        await self.ctx.database.execute(query, params)
+        # ROW_COUNT() is per connection, so hold one for the whole operation
+        async with self.ctx.database.connection():
+            await self.ctx.database.execute(query, params)
+            row = await self.ctx.database.fetch_one(
+                f"""\
+                SELECT
+                  ROW_COUNT() AS added,
+                  (SELECT COUNT(*) FROM stream_tokens WHERE stream_name = :stream_name) AS client_count
+                """,
+                {"stream_name": stream_name},
+            )
+            assert row is not None
+
+        return row["added"] == 1, row["client_count"]
+
+    async def add_clients(
+        self,
+        stream_names: list[str],
+        token_id: str,
+    ) -> list[tuple[bool, int]]:
+        if not stream_names:
+            return []
+
+        joined_stream_names = {
+            stream["stream_name"]
+            for stream in await self.fetch_client_streams(token_id)
+        }
+        new_stream_names = [
+            stream_name
+            for stream_name in stream_names
+            if stream_name not in joined_stream_names
+        ]
+
+        if new_stream_names:
+            values = ", ".join(
+                f"(:stream_name_{i}, :token_id_{i})"
+                for i in range(len(new_stream_names))
+            )
+            query = f"""\
+                INSERT IGNORE INTO stream_tokens (stream_name, token_id)
+                VALUES {values}
+            """
+            params: dict[str, Any] = {}
+            for i, stream_name in enumerate(new_stream_names):
+                params[f"stream_name_{i}"] = stream_name
+                params[f"token_id_{i}"] = token_id
+
+            await self.ctx.database.execute(query, params)
+
+        client_counts = await self.count_clients_many(stream_names)
+        return [
+            (stream_name in new_stream_names, client_count)
+            for stream_name, client_count in zip(stream_names, client_counts)
+        ]
 
     async def remove_client(
         self,
         stream_name: str,
         token_id: str,
-    ) -> None:
+    ) -> tuple[bool, int]:
         query = """\
-            DELETE FROM 
+            DELETE FROM
               stream_tokens
             WHERE
-              stream_name = :stream_name 
+              stream_name = :stream_name
               AND token_id = :token_id
         """
         params = {
@@ -133,4 +272,161 @@ class StreamsRepository:
             "token_id": token_id,
         }
 
+        # ROW_COUNT() is per connection, so hold one for the whole operation
+        async with self.ctx.database.connection():
+            await self.ctx.database.execute(query, params)
+            row = await self.ctx.database.fetch_one(
+                f"""\
+                SELECT
+                  ROW_COUNT() AS removed,
+                  (SELECT COUNT(*) FROM stream_tokens WHERE stream_name = :stream_name) AS client_count
+                """,
+                {"stream_name": stream_name},
+            )
+            assert row is not None
+
+        return row["removed"] == 1, row["client_count"]
+
+    async def purge_clients(self, token_ids: list[str]) -> dict[str, int]:
+        """Removes the clients from every stream, returning each affected stream's
+        remaining client count."""
+        if not token_ids:
+            return {}
+
+        query = f"""\
+            SELECT DISTINCT
+              stream_name
+            FROM
+              stream_tokens
+            WHERE
+              token_id IN :token_ids
+        """
+        params = {"token_ids": token_ids}
+
+        streams = await self.ctx.database.fetch_all(query, params)
+        stream_names = [stream["stream_name"] for stream in streams]
+
+        query = f"""\
+            DELETE FROM
+              stream_tokens
+            WHERE
+              token_id IN :token_ids
+        """
         await self.ctx.database.execute(query, params)
+
+        client_counts = await self.count_clients_many(stream_names)
+        return dict(zip(stream_names, client_counts))
+
+
+class RedisStreamsRepository(StreamsRepository):
+    """Keeps stream membership in redis sets, and stream rows in mysql."""
+
+    def clients_key(self, stream_name: str) -> str:
+        return f"akatsuki:streams:{stream_name}:clients"
+
+    def client_streams_key(self, token_id: str) -> str:
+        return f"akatsuki:tokens:{token_id}:streams"
+
+    async def delete_one(self, stream_name: str) -> None:
+        await super().delete_one(stream_name)
+        await self.ctx.redis.delete(self.clients_key(stream_name))
+
+    async def fetch_clients(
+        self,
+        stream_name: str,
+    ) -> list[dict[str, Any]]:
+        clients = await self.ctx.redis.smembers(self.clients_key(stream_name))
+        return [{"token_id": client.decode()} for client in clients]
+
+    async def fetch_client_streams(
+        self,
+        token_id: str,
+    ) -> list[dict[str, Any]]:
+        streams = await self.ctx.redis.smembers(self.client_streams_key(token_id))
+        return [{"stream_name": stream.decode()} for stream in streams]
+
+    async def count_clients(
+        self,
+        stream_name: str,
+    ) -> int:
+        return await self.ctx.redis.scard(self.clients_key(stream_name))
+
+    async def count_clients_many(
+        self,
+        stream_names: list[str],
+    ) -> list[int]:
+        async with self.ctx.redis.pipeline() as pipe:
+            for stream_name in stream_names:
+                pipe.scard(self.clients_key(stream_name))
+
+            return await pipe.execute()
+
+    async def add_client(
+        self,
+        stream_name: str,
+        token_id: str,
+    ) -> tuple[bool, int]:
+        add_client_script = self.ctx.redis.register_script(ADD_CLIENT_SCRIPT)
+        added, client_count = await add_client_script(
+            keys=[self.clients_key(stream_name), self.client_streams_key(token_id)],
+            args=[token_id, stream_name],
+        )
+        return added == 1, client_count
+
+    async def add_clients(
+        self,
+        stream_names: list[str],
+        token_id: str,
+    ) -> list[tuple[bool, int]]:
+        if not stream_names:
+            return []
+
+        async with self.ctx.redis.pipeline(transaction=True) as pipe:
+            for stream_name in stream_names:
+                pipe.sadd(self.clients_key(stream_name), token_id)
+                pipe.scard(self.clients_key(stream_name))
+            pipe.sadd(self.client_streams_key(token_id), *stream_names)
+
+            results = await pipe.execute()
+
+        return [
+            (added == 1, client_count)
+            for added, client_count in zip(results[0:-1:2], results[1:-1:2])
+        ]
+
+    async def remove_client(
+        self,
+        stream_name: str,
+        token_id: str,
+    ) -> tuple[bool, int]:
+        remove_client_script = self.ctx.redis.register_script(REMOVE_CLIENT_SCRIPT)
+        removed, client_count = await remove_client_script(
+            keys=[self.clients_key(stream_name), self.client_streams_key(token_id)],
+            args=[token_id, stream_name],
+        )
+        return removed == 1, client_count
+
+    async def purge_clients(self, token_ids: list[str]) -> dict[str, int]:
+        if not token_ids:
+            return {}
+
+        async with self.ctx.redis.pipeline() as pipe:
+            for token_id in token_ids:
+                pipe.smembers(self.client_streams_key(token_id))
+
+            client_streams = await pipe.execute()
+
+        stream_clients: dict[str, list[str]] = {}
+        for token_id, streams in zip(token_ids, client_streams):
+            for stream in streams:
+                stream_clients.setdefault(stream.decode(), []).append(token_id)
+
+        async with self.ctx.redis.pipeline(transaction=True) as pipe:
+            for stream_name, clients in stream_clients.items():
+                pipe.srem(self.clients_key(stream_name), *clients)
+                pipe.scard(self.clients_key(stream_name))
+            pipe.delete(*[self.client_streams_key(token_id) for token_id in token_ids])
+
+            results = await pipe.execute()
+
+        return dict(zip(stream_clients, results[1:-1:2]))
@@ -1,40 +1,82 @@
 from app.common.context import Context
+from app.common.sql import build_filters
 from typing import Any
 
 import orjson
 
+PING_TIMES_KEY = "akatsuki:tokens:ping_times"
+PRESENCES_KEY = "akatsuki:tokens:presences"
+
+# KEYS[1] - session claim key
+# ARGV[1] - expected token id
+# ARGV[2] - new token id
+# ARGV[3] - claim timeout, in milliseconds
+REPLACE_SESSION_CLAIM_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("SET", KEYS[1], ARGV[2], "PX", ARGV[3])
+return 1
+"""
+
+# KEYS[1] - session claim key
+# ARGV[1] - expected token id
+RELEASE_SESSION_CLAIM_SCRIPT = """
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call("DEL", KEYS[1])
+"""
+
 
 class TokensRepository:
     def __init__(self, ctx: Context) -> None:
         self.ctx = ctx
 
-        self.READ_PARAMS = (
-            "token_id, user_id, username, privileges, whitelist, kicked, login_time, ping_time, utc_offset, tournament, "
-            "block_non_friends_dm, spectating_token_id, spectating_user_id, latitude, longitude, ip, country, away_message, "
-            "match_id, last_np_beatmap_id, last_np_mods, last_np_accuracy, silence_end_time, protocol_version, spam_rate, "
-            "action_id, action_text, action_md5, action_beatmap_id, action_mods, mode, relax, autopilot, ranked_score, accuracy, "
+        # login-time session data, written once per token
+        self.SESSION_PARAMS = (
+            "token_id, user_id, username, privileges, whitelist, login_time, utc_offset, tournament, "
+            "block_non_friends_dm, latitude, longitude, ip, country, silence_end_time, protocol_version, "
+            "instance_id"
+        )
+        # frequently updated state, kept in a narrow table of its own
+        self.STATE_PARAMS = (
+            "kicked, ping_time, spectating_token_id, spectating_user_id, away_message, match_id, "
+            "last_np_beatmap_id, last_np_mods, last_np_accuracy, spam_rate, action_id, action_text, "
+            "action_md5, action_beatmap_id, action_mods, mode, relax, autopilot, ranked_score, accuracy, "
             "playcount, total_score, global_rank, pp"
         )
+        self.READ_PARAMS = f"{self.SESSION_PARAMS}, {self.STATE_PARAMS}"
+
+        self.STATE_FIELDS = set(self.STATE_PARAMS.split(", "))
+
+    def _read_source(self, fields: list[str] | None) -> tuple[str, str]:
+        if fields is None:
+            return self.READ_PARAMS, "tokens JOIN token_states USING (token_id)"
+
+        if self.STATE_FIELDS.intersection(fields):
+            return ", ".join(fields), "tokens JOIN token_states USING (token_id)"
+
+        return ", ".join(fields), "tokens"
 
     async def fetch_one(
         self,
         token_id: str | None = None,
         user_id: int | None = None,
         username: str | None = None,
+        fields: list[str] | None = None,
     ) -> dict[str, Any] | None:
+        read_params, source = self._read_source(fields)
+        filters, params = build_filters(
+            token_id=token_id,
+            user_id=user_id,
+            username=username,
+        )
         query = f"""\
-            SELECT {self.READ_PARAMS}
-              FROM tokens
-            WHERE
-              token_id = COALESCE(:token_id, token_id)
-              AND user_id = COALESCE(:user_id, user_id)
-              AND username = COALESCE(:username, username)
+            SELECT {read_params}
+              FROM {source}
+            {filters}
         """
-        params = {
-            "token_id": token_id,
-            "user_id": user_id,
-            "username": username,
-        }
 
         token = await self.ctx.database.fetch_one(query, params)
         return token
@@ -44,20 +86,40 @@ class TokensRepository:
         token_id: str | None = None,
         user_id: int | None = None,
         username: str | None = None,
+        instance_id: str | None = None,
+        fields: list[str] | None = None,
     ) -> list[dict[str, Any]]:
+        read_params, source = self._read_source(fields)
+        filters, params = build_filters(
+            token_id=token_id,
+            user_id=user_id,
+            username=username,
+            instance_id=instance_id,
+        )
         query = f"""\
-            SELECT {self.READ_PARAMS}
-              FROM tokens 
-            WHERE
-              token_id = COALESCE(:token_id, token_id)
-              AND user_id = COALESCE(:user_id, user_id)
-              AND username = COALESCE(:username, username)
+            SELECT {read_params}
+              FROM {source}
+            {filters}
         """
-        params = {
-            "token_id": token_id,
-            "user_id": user_id,
-            "username": username,
-        }
+
+        tokens = await self.ctx.database.fetch_all(query, params)
+        return tokens
+
+    async def fetch_many(
+        self,
+        token_ids: list[str],
+        fields: list[str] | None = None,
+    ) -> list[dict[str, Any]]:
+        if not token_ids:
+            return []
+
+        read_params, source = self._read_source(fields)
+        query = f"""\
+            SELECT {read_params}
+              FROM {source}
+            WHERE token_id IN :token_ids
+        """
+        params = {"token_ids": token_ids}
 
         tokens = await self.ctx.database.fetch_all(query, params)
         return tokens
@@ -88,6 +150,7 @@ class TokensRepository:
         last_np_accuracy: float | None,
         silence_end_time: int,
         protocol_version: int,
+        instance_id: str,
         spam_rate: int,
         action_id: int,
         action_text: str,
@@ -104,15 +167,6 @@ class TokensRepository:
         global_rank: int,
         pp: int,
     ) -> None:
-        query = f"""\
-            INSERT INTO tokens ({self.READ_PARAMS})
-            VALUES (:token_id, :user_id, :username, :privileges, :whitelist, :kicked, :login_time, :ping_time, 
-            :utc_offset, :tournament, :block_non_friends_dm, :spectating_token_id, :spectating_user_id, 
-            :latitude, :longitude, :ip, :country, :away_message, :match_id, :last_np_beatmap_id, 
-            :last_np_mods, :last_np_accuracy, :silence_end_time, :protocol_version, :spam_rate, 
-            :action_id, :action_text, :action_md5, :action_beatmap_id, :action_mods, :mode, :relax, :autopilot, 
-            :ranked_score, :accuracy, :playcount, :total_score, :global_rank, :pp)
-        """
         params = {
             "token_id": token_id,
             "user_id": user_id,
@@ -138,6 +192,7 @@ class TokensRepository:
             "last_np_accuracy": last_np_accuracy,
             "silence_end_time": silence_end_time,
             "protocol_version": protocol_version,
+            "instance_id": instance_id,
             "spam_rate": spam_rate,
             "action_id": action_id,
             "action_text": action_text,
@@ -155,17 +210,55 @@ class TokensRepository:
             "pp": pp,
         }
 
-        await self.ctx.database.execute(query, params)
+        query = f"""\
+            INSERT INTO tokens ({self.SESSION_PARAMS})
+            VALUES (:token_id, :user_id, :username, :privileges, :whitelist, :login_time, :utc_offset,
+            :tournament, :block_non_friends_dm, :latitude, :longitude, :ip, :country, :silence_end_time,
+            :protocol_version, :instance_id)
+        """
+        session_params = {
+            key: value for key, value in params.items() if key not in self.STATE_FIELDS
+        }
+        await self.ctx.database.execute(query, session_params)
 
-    async def partial_update(self, token_id: str, **updates: Any) -> dict[str, Any]:
         query = f"""\
-            UPDATE tokens
-               SET {', '.join(f'{key} = :{key}' for key in updates)}
-             WHERE token_id = :token_id
+            INSERT INTO token_states (token_id, {self.STATE_PARAMS})
+            VALUES (:token_id, :kicked, :ping_time, :spectating_token_id, :spectating_user_id,
+            :away_message, :match_id, :last_np_beatmap_id, :last_np_mods, :last_np_accuracy, :spam_rate,
+            :action_id, :action_text, :action_md5, :action_beatmap_id, :action_mods, :mode, :relax,
+            :autopilot, :ranked_score, :accuracy, :playcount, :total_score, :global_rank, :pp)
         """
-        params = {"token_id": token_id, **updates}
+        state_params = {
+            key: value
+            for key, value in params.items()
+            if key in self.STATE_FIELDS or key == "token_id"
+        }
+        await self.ctx.database.execute(query, state_params)
 
-        await self.ctx.database.execute(query, params)
+    async def partial_update(self, token_id: str, **updates: Any) -> dict[str, Any]:
+        session_updates = {
+            key: value for key, value in updates.items() if key not in self.STATE_FIELDS
+        }
+        state_updates = {
+            key: value for key, value in updates.items() if key in self.STATE_FIELDS
+        }
+
+        # only rewrite the rows which actually changed
+        for table, table_updates in (
+            ("tokens", session_updates),
+            ("token_states", state_updates),
+        ):
+            if not table_updates:
+                continue
+
+            query = f"""\
+                UPDATE {table}
+                   SET {', '.join(f'{key} = :{key}' for key in table_updates)}
+                 WHERE token_id = :token_id
+            """
+            params = {"token_id": token_id, **table_updates}
+
+            await self.ctx.database.execute(query, params)
 
         token = await self.fetch_one(token_id)
         assert token is not None
@@ -173,15 +266,49 @@ class TokensRepository:
 
     async def delete_one(self, token_id: str) -> None:
         query = f"""\
-            DELETE FROM
-              tokens
+            DELETE tokens, token_states
+              FROM tokens
+              LEFT JOIN token_states USING (token_id)
             WHERE
-              token_id = :token_id
+              tokens.token_id = :token_id
         """
         params = {"token_id": token_id}
 
         await self.ctx.database.execute(query, params)
 
+    async def delete_many(self, token_ids: list[str]) -> None:
+        query = f"""\
+            DELETE tokens, token_states
+              FROM tokens
+              LEFT JOIN token_states USING (token_id)
+            WHERE
+              tokens.token_id IN :token_ids
+        """
+        params = {"token_ids": token_ids}
+
+        await self.ctx.database.execute(query, params)
+
+    async def enqueue_many(self, token_ids: list[str], data: list[int]) -> None:
+        if not token_ids:
+            return
+
+        # parameters are substituted once per name, so every row needs its own
+        values = ", ".join(
+            f"(:token_id_{idx}, :data_{idx})" for idx in range(len(token_ids))
+        )
+        query = f"""\
+            INSERT INTO token_buffers (token_id, buffer)
+            VALUES {values}
+        """
+        encoded_data = orjson.dumps(data).decode()
+
+        params: dict[str, Any] = {}
+        for idx, token_id in enumerate(token_ids):
+            params[f"token_id_{idx}"] = token_id
+            params[f"data_{idx}"] = encoded_data
+
+        await self.ctx.database.execute(query, params)
+
     async def enqueue(self, token_id: str, data: list[int]) -> None:
         query = f"""\
             INSERT INTO token_buffers (token_id, buffer)
@@ -210,14 +337,146 @@ class TokensRepository:
         params = {"token_id": token_id}
 
         data = await self.ctx.database.fetch_all(query, params)
-        for buffer in data:
-            query = """\
-                DELETE FROM token_buffers
-                WHERE buffer_id = :buffer_id
-            """
-            params = {
-                "buffer_id": buffer["buffer_id"],
-            }
-            await self.ctx.database.execute(query, params)
+        if not data:
+            return data
+
+        # buffers enqueued after our read must survive until the next dequeue
+        query = """\
+            DELETE FROM token_buffers
+            WHERE
+              token_id = :token_id
+              AND buffer_id <= :last_buffer_id
+        """
+        params = {
+            "token_id": token_id,
+            "last_buffer_id": data[-1]["buffer_id"],
+        }
+        await self.ctx.database.execute(query, params)
 
         return data
+
+    async def delete_buffers(self, token_ids: list[str]) -> None:
+        query = f"""\
+            DELETE FROM
+              token_buffers
+            WHERE
+              token_id IN :token_ids
+        """
+        params = {"token_ids": token_ids}
+
+        await self.ctx.database.execute(query, params)
+
+    async def update_ping_times(self, ping_times: dict[str, int]) -> None:
+        cases = "\n".join(
+            f"WHEN :token_id_{i} THEN :ping_time_{i}" for i in range(len(ping_times))
+        )
+        query = f"""\
+            UPDATE token_states
+               SET ping_time = CASE token_id {cases} END
+             WHERE token_id IN :token_ids
+        """
+        params: dict[str, Any] = {}
+        for i, (token_id, ping_time) in enumerate(ping_times.items()):
+            params[f"token_id_{i}"] = token_id
+            params[f"ping_time_{i}"] = ping_time
+        params["token_ids"] = list(ping_times)
+
+        await self.ctx.database.execute(query, params)
+
+        # xx: never re-index tokens which have expired since their last ping
+        await self.ctx.redis.zadd(PING_TIMES_KEY, ping_times, xx=True)
+
+    async def index_ping_time(self, token_id: str, ping_time: int) -> None:
+        await self.ctx.redis.zadd(PING_TIMES_KEY, {token_id: ping_time})
+
+    async def fetch_stale_token_ids(self, ping_cutoff: int, limit: int) -> list[str]:
+        token_ids = await self.ctx.redis.zrangebyscore(
+            PING_TIMES_KEY,
+            "-inf",
+            ping_cutoff,
+            start=0,
+            num=limit,
+        )
+        return [token_id.decode() for token_id in token_ids]
+
+    async def remove_ping_times(self, token_ids: list[str]) -> list[str]:
+        """Returns the token ids which were still indexed."""
+        async with self.ctx.redis.pipeline() as pipe:
+            for token_id in token_ids:
+                pipe.zrem(PING_TIMES_KEY, token_id)
+
+            removed = await pipe.execute()
+
+        return [
+            token_id
+            for token_id, was_removed in zip(token_ids, removed)
+            if was_removed == 1
+        ]
+
+    def session_claim_key(self, user_id: int) -> str:
+        return f"akatsuki:sessions:{user_id}"
+
+    async def claim_session(self, user_id: int, token_id: str, timeout: int) -> bool:
+        claimed = await self.ctx.redis.set(
+            self.session_claim_key(user_id),
+            token_id,
+            nx=True,
+            px=timeout,
+        )
+        return claimed is not None
+
+    async def fetch_session_claim(self, user_id: int) -> tuple[str, bool] | None:
+        """Returns the claiming token id, and whether the claim is still pending."""
+        async with self.ctx.redis.pipeline() as pipe:
+            pipe.get(self.session_claim_key(user_id))
+            pipe.pttl(self.session_claim_key(user_id))
+
+            token_id, ttl = await pipe.execute()
+
+        if token_id is None:
+            return None
+
+        return token_id.decode(), ttl >= 0
+
+    async def confirm_session_claim(self, user_id: int) -> None:
+        await self.ctx.redis.persist(self.session_claim_key(user_id))
+
+    async def replace_session_claim(
+        self,
+        user_id: int,
+        old_token_id: str,
+        new_token_id: str,
+        timeout: int,
+    ) -> bool:
+        replace_script = self.ctx.redis.register_script(REPLACE_SESSION_CLAIM_SCRIPT)
+        replaced = await replace_script(
+            keys=[self.session_claim_key(user_id)],
+            args=[old_token_id, new_token_id, timeout],
+        )
+        return replaced == 1
+
+    async def release_session_claims(self, claims: dict[str, int]) -> None:
+        """Releases the user's claims which are still held by the given tokens."""
+        release_script = self.ctx.redis.register_script(RELEASE_SESSION_CLAIM_SCRIPT)
+
+        async with self.ctx.redis.pipeline() as pipe:
+            for token_id, user_id in claims.items():
+                await release_script(
+                    keys=[self.session_claim_key(user_id)],
+                    args=[token_id],
+                    client=pipe,
+                )
+
+            await pipe.execute()
+
+    async def set_presence(self, token_id: str, packet: bytes) -> None:
+        await self.ctx.redis.hset(PRESENCES_KEY, token_id, packet)
+
+    async def delete_presences(self, token_ids: list[str]) -> None:
+        if not token_ids:
+            return
+
+        await self.ctx.redis.hdel(PRESENCES_KEY, *token_ids)
+
+    async def fetch_presences(self) -> list[bytes]:
+        return await self.ctx.redis.hvals(PRESENCES_KEY)
@@ -1,4 +1,5 @@
 from app.common.context import Context
+from app.common.sql import build_filters
 
 from typing import Any
 
@@ -19,16 +20,12 @@ class UsersRepository:
         id: int | None = None,
         username: str | None = None,
     ) -> dict[str, Any] | None:
+        filters, params = build_filters(id=id, username=username)
         query = f"""\
             SELECT {self.READ_PARAMS}
               FROM users
-            WHERE id = COALESCE(:id, id)
-              AND username = COALESCE(:username, username)
+            {filters}
         """
-        params = {
-            "id": id,
-            "username": username,
-        }
 
         user = await self.ctx.database.fetch_one(query, params)
         return user
@@ -1,41 +1,171 @@
 from app.repositories.channels import ChannelsRepository
+from app.repositories.instance_channels import InstanceChannelsRepository
 from app.usecases import tokens as tokens_usecases
 from app.usecases import streams as streams_usecases
+from app.usecases import users as users_usecases
 from app.common.context import Context
 from app.models.channel import Channel
+from app.models.channel_registry import ChannelRegistry
+from app.models.privileges import Privileges
 from app.common import logger
+from app.common import serial
+from app.common import settings
 from typing import Any
 
+import time
+
+CHANNEL_INFO_PACKETS_KEY = "akatsuki:channels:info_packets"
+CHANNELS_VERSION_KEY = "akatsuki:channels:version"
+
+
+async def fetch_registry(ctx: Context) -> ChannelRegistry:
+    registry = ctx.channel_registry
+
+    now = time.time()
+    check_interval = settings.CHANNEL_REGISTRY_CHECK_INTERVAL / 1000
+    if registry.version is not None and now - registry.checked_at < check_interval:
+        return registry
+
+    # read the version first, so a concurrent change can only make us reload twice
+    version = int(await ctx.redis.get(CHANNELS_VERSION_KEY) or 0)
+    if version != registry.version:
+        repo = ChannelsRepository(ctx)
+
+        channels = await repo.fetch_all()
+        registry.load([Channel.parse_obj(channel) for channel in channels], version)
+
+    registry.checked_at = now
+    return registry
+
+
+async def bump_registry_version(ctx: Context) -> None:
+    await ctx.redis.incr(CHANNELS_VERSION_KEY)
+    ctx.channel_registry.invalidate()
+
+
+def is_instance_channel(channel_name: str) -> bool:
+    return channel_name.startswith(("#spect_", "#multi_"))
+
 
 async def fetch_one(
     ctx: Context,
     channel_name: str,
 ) -> Channel | None:
-    repo = ChannelsRepository(ctx)
+    if is_instance_channel(channel_name):
+        repo = InstanceChannelsRepository(ctx)
 
-    channel = await repo.fetch_one(channel_name)
-    if channel is None:
-        return None
+        channel = await repo.fetch_one(channel_name)
+        if channel is None:
+            return None
 
-    return Channel.parse_obj(channel)
+        return Channel.parse_obj(channel)
+
+    registry = await fetch_registry(ctx)
+    return registry.channels.get(channel_name)
 
 
 async def fetch_all(ctx: Context) -> list[Channel]:
-    repo = ChannelsRepository(ctx)
+    registry = await fetch_registry(ctx)
+
+    repo = InstanceChannelsRepository(ctx)
+    instance_channels = await repo.fetch_all()
+
+    return list(registry.channels.values()) + [
+        Channel.parse_obj(channel) for channel in instance_channels
+    ]
+
+
+def check_read_permission(privileges: int, channel: Channel) -> bool:
+    if channel.name == "#premium" and not privileges & Privileges.USER_PREMIUM:
+        return False
+
+    if channel.name == "#supporter" and not privileges & Privileges.USER_DONOR:
+        return False
+
+    return channel.public_read or users_usecases.is_staff(privileges)
+
+
+def check_write_permission(privileges: int, channel: Channel) -> bool:
+    if not check_read_permission(privileges, channel):
+        return False
+
+    if channel.moderated or not channel.public_write:
+        return users_usecases.is_staff(privileges)
+
+    return True
+
+
+def get_permission_masks(
+    registry: ChannelRegistry,
+    privileges: int,
+) -> tuple[int, int]:
+    """Returns the read and write masks of registry channel bits for `privileges`."""
+    masks = registry.permission_masks.get(privileges)
+    if masks is not None:
+        return masks
+
+    read_mask = write_mask = 0
+    for channel in registry.channels.values():
+        if check_read_permission(privileges, channel):
+            read_mask |= registry.bits[channel.name]
+
+        if check_write_permission(privileges, channel):
+            write_mask |= registry.bits[channel.name]
+
+    masks = registry.permission_masks[privileges] = (read_mask, write_mask)
+    return masks
+
+
+async def can_read(ctx: Context, privileges: int, channel: Channel) -> bool:
+    registry = await fetch_registry(ctx)
+
+    bit = registry.bits.get(channel.name)
+    if bit is None:  # instance channels aren't in the registry
+        return check_read_permission(privileges, channel)
+
+    read_mask, _ = get_permission_masks(registry, privileges)
+    return read_mask & bit != 0
+
+
+async def can_write(ctx: Context, privileges: int, channel: Channel) -> bool:
+    registry = await fetch_registry(ctx)
+
+    bit = registry.bits.get(channel.name)
+    if bit is None:
+        return check_write_permission(privileges, channel)
+
+    _, write_mask = get_permission_masks(registry, privileges)
+    return write_mask & bit != 0
+
 
-    channels = await repo.fetch_all()
-    return [Channel.parse_obj(channel) for channel in channels]
+def get_stream_name(channel_name: str) -> str:
+    return f"chat/{channel_name}"
 
 
 async def fetch_clients(
     ctx: Context,
-    token_id: str | None = None,
-    channel_name: str | None = None,
-) -> list[dict[str, Any]]:
-    repo = ChannelsRepository(ctx)
+    channel_name: str,
+) -> list[str]:
+    return await streams_usecases.fetch_clients(ctx, get_stream_name(channel_name))
+
+
+async def fetch_client_channels(
+    ctx: Context,
+    token_id: str,
+) -> list[str]:
+    stream_names = await streams_usecases.fetch_client_streams(ctx, token_id)
+    return [
+        stream_name[len("chat/") :]
+        for stream_name in stream_names
+        if stream_name.startswith("chat/")
+    ]
 
-    clients = await repo.fetch_clients(token_id=token_id, channel_name=channel_name)
-    return clients
+
+async def count_clients(
+    ctx: Context,
+    channel_name: str,
+) -> int:
+    return await streams_usecases.count_clients(ctx, get_stream_name(channel_name))
 
 
 async def create_one(
@@ -47,7 +177,22 @@ async def create_one(
     moderated: bool,
     instance: bool,
 ) -> Channel:
-    await streams_usecases.create_one(ctx, f"chat/{channel_name}")
+    if is_instance_channel(channel_name):
+        instance_repo = InstanceChannelsRepository(ctx)
+
+        # membership lives in the stream's client set, so no stream row is needed
+        raw_channel = await instance_repo.create_one(
+            channel_name,
+            description,
+            public_read,
+            public_write,
+            moderated,
+        )
+
+        logger.info(f"Created channel {channel_name}.")
+        return Channel.parse_obj(raw_channel)
+
+    await streams_usecases.create_one(ctx, get_stream_name(channel_name))
 
     repo = ChannelsRepository(ctx)
 
@@ -60,12 +205,16 @@ async def create_one(
         instance,
     )
     channel = Channel.parse_obj(raw_channel)
+    await bump_registry_version(ctx)
 
-    bot = await tokens_usecases.fetch_one(ctx, user_id=999)
+    bot = await tokens_usecases.fetch_session(ctx, user_id=999)
     assert bot is not None
 
     await tokens_usecases.join_channel(ctx, bot.token_id, channel.name)
 
+    if not instance:
+        await invalidate_channel_info_packets(ctx)
+
     logger.info(f"Created channel {channel_name}.")
     return channel
 
@@ -74,23 +223,29 @@ async def delete_one(
     ctx: Context,
     channel_name: str,
 ) -> None:
-    clients = await streams_usecases.fetch_clients(ctx, f"chat/{channel_name}")
+    # kick everyone here, as leave_channel would recurse into deleting us
+    kick_packet = serial.write_channel_kick_packet(get_client_name(channel_name))
+    clients = await fetch_clients(ctx, channel_name)
     for client in clients:
-        token = await tokens_usecases.fetch_one(ctx, token_id=client)
-        if token is None:
-            continue
+        await tokens_usecases.enqueue(ctx, client, kick_packet)
 
-        await tokens_usecases.leave_channel(
-            ctx,
-            token.token_id,
-            channel_name,
-            kick=True,
-        )
+    if is_instance_channel(channel_name):
+        for client in clients:
+            await remove_client(ctx, channel_name, client)
+
+        instance_repo = InstanceChannelsRepository(ctx)
+        await instance_repo.delete_one(channel_name)
 
-    await streams_usecases.delete_one(ctx, f"chat/{channel_name}")
+        logger.info(f"Removed channel {channel_name}")
+        return
+
+    await streams_usecases.delete_one(ctx, get_stream_name(channel_name))
 
     repo = ChannelsRepository(ctx)
     await repo.delete_one(channel_name)
+    await bump_registry_version(ctx)
+
+    await invalidate_channel_info_packets(ctx)
 
     logger.info(f"Removed channel {channel_name}")
 
@@ -103,6 +258,10 @@ async def partial_update(
     repo = ChannelsRepository(ctx)
 
     channel = await repo.partial_update(channel_name, **updates)
+    await bump_registry_version(ctx)
+
+    await invalidate_channel_info_packets(ctx)
+
     return Channel.parse_obj(channel)
 
 
@@ -110,18 +269,27 @@ async def add_client(
     ctx: Context,
     channel_name: str,
     token_id: str,
-) -> None:
-    repo = ChannelsRepository(ctx)
-    await repo.add_client(channel_name, token_id)
+) -> tuple[bool, int]:
+    stream_name = get_stream_name(channel_name)
+    return await streams_usecases.add_client(ctx, stream_name, token_id)
+
+
+async def add_clients(
+    ctx: Context,
+    channel_names: list[str],
+    token_id: str,
+) -> list[tuple[bool, int]]:
+    stream_names = [get_stream_name(channel_name) for channel_name in channel_names]
+    return await streams_usecases.add_clients(ctx, stream_names, token_id)
 
 
 async def remove_client(
     ctx: Context,
     channel_name: str,
     token_id: str,
-) -> None:
-    repo = ChannelsRepository(ctx)
-    await repo.remove_client(channel_name, token_id)
+) -> tuple[bool, int]:
+    stream_name = get_stream_name(channel_name)
+    return await streams_usecases.remove_client(ctx, stream_name, token_id)
 
 
 def get_client_name(channel_name: str) -> str:
@@ -131,3 +299,40 @@ def get_client_name(channel_name: str) -> str:
         return "#multiplayer"
 
     return channel_name
+
+
+async def fetch_channel_info_packets(ctx: Context) -> bytes:
+    """Fetch the channel list sent on login, rebuilt at a bounded rate."""
+    cached_packets = await ctx.redis.get(CHANNEL_INFO_PACKETS_KEY)
+    if cached_packets is not None:
+        return cached_packets
+
+    channels = [
+        channel
+        for channel in await fetch_all(ctx)
+        if channel.public_read and not channel.instance
+    ]
+    client_counts = await streams_usecases.count_clients_many(
+        ctx,
+        [get_stream_name(channel.name) for channel in channels],
+    )
+
+    packets = bytearray()
+    for channel, client_count in zip(channels, client_counts):
+        packets += serial.write_channel_info_packet(
+            channel.name,
+            channel.description,
+            client_count,
+        )
+    packets += serial.write_channel_info_end_packet()
+
+    await ctx.redis.set(
+        CHANNEL_INFO_PACKETS_KEY,
+        bytes(packets),
+        px=settings.CHANNEL_INFO_REFRESH_INTERVAL,
+    )
+    return bytes(packets)
+
+
+async def invalidate_channel_info_packets(ctx: Context) -> None:
+    await ctx.redis.delete(CHANNEL_INFO_PACKETS_KEY)
@@ -1,7 +1,7 @@
 from app.common.context import Context
+from app.common import logger
 
-import asyncio
-import bcrypt
+import time
 
 
 async def verify_bcrypt_password(
@@ -9,18 +9,25 @@ async def verify_bcrypt_password(
     password_md5: str,
     bcrypt_hash: str,
 ) -> bool:
-    cached_md5 = await ctx.bcrypt_cache.get(bcrypt_hash)
-    if cached_md5 is not None:
-        return password_md5 == cached_md5
+    """Raises `BcryptPoolFull` when too many checks are already waiting."""
 
-    loop = asyncio.get_running_loop()
-    result = await loop.run_in_executor(
-        None,
-        bcrypt.checkpw,
-        password_md5.encode(),
-        bcrypt_hash.encode(),
-    )
-    if result:
-        await ctx.bcrypt_cache.set(bcrypt_hash, password_md5)
+    async def check_password() -> bool | None:
+        start_time = time.perf_counter()
+        result = await ctx.bcrypt_pool.checkpw(
+            password_md5.encode(),
+            bcrypt_hash.encode(),
+        )
+        logger.debug(
+            "Verified bcrypt password",
+            elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2),
+            pending=ctx.bcrypt_pool.pending,
+        )
+
+        # only correct passwords are cached
+        return result or None
 
-    return result
+    result = await ctx.bcrypt_cache.get_or_set(
+        f"{bcrypt_hash}:{password_md5}",
+        check_password,
+    )
+    return result is True
@@ -1,4 +1,15 @@
 from app.models.login_data import LoginData
+from app.common.context import Context
+from app.common import logger
+from app.common import settings
+from app.common.tasks import create_isolated_task
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Coroutine
+
+import asyncio
+import time
 
 def parse_login_data(data: bytes) -> LoginData:
     (
@@ -35,4 +46,55 @@ def parse_login_data(data: bytes) -> LoginData:
         adapters_md5=adapters_md5,
         uninstall_md5=uninstall_md5,
         disk_signature_md5=disk_signature_md5,
-    )
\ No newline at end of file
+    )
+
+
+async def gather_steps(**steps: Coroutine[Any, Any, Any]) -> dict[str, Any]:
+    """Runs independent login steps concurrently, returning their results by name."""
+    semaphore = asyncio.Semaphore(settings.LOGIN_STEP_CONCURRENCY)
+
+    async def run_step(name: str, step: Coroutine[Any, Any, Any]) -> Any:
+        async with semaphore:
+            start_time = time.perf_counter()
+            try:
+                return await step
+            finally:
+                logger.debug(
+                    "Login step finished",
+                    step=name,
+                    elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2),
+                )
+
+    tasks = [create_isolated_task(run_step(name, step)) for name, step in steps.items()]
+
+    try:
+        results = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+
+        raise
+
+    return dict(zip(steps, results))
+
+
+async def run_side_effect(
+    ctx: Context,
+    name: str,
+    func: Callable[..., Awaitable[Any]],
+    *args: Any,
+    **kwargs: Any,
+) -> None:
+    """Runs a side effect after the response was sent, logging rather than raising."""
+    async with ctx.side_effect_limiter:
+        start_time = time.perf_counter()
+        try:
+            await func(*args, **kwargs)
+        except Exception:
+            logger.error("Login side effect failed", side_effect=name, exc_info=True)
+        else:
+            logger.debug(
+                "Login side effect finished",
+                side_effect=name,
+                elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2),
+            )
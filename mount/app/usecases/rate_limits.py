@@ -0,0 +1,17 @@
+from app.repositories.rate_limits import RateLimitsRepository
+from app.common.context import Context
+from app.common import settings
+
+
+async def allow_login_attempt(ctx: Context, ip: str | None, username: str) -> bool:
+    repo = RateLimitsRepository(ctx)
+
+    limits = {
+        f"akatsuki:ratelimits:login:username:{username.lower()}": (
+            settings.LOGIN_USERNAME_RATE_LIMIT
+        ),
+    }
+    # an unknown ip would lump every such client into one shared limit
+    if ip is not None:
+        limits[f"akatsuki:ratelimits:login:ip:{ip}"] = settings.LOGIN_IP_RATE_LIMIT
+    return await repo.record_attempt(limits, settings.LOGIN_RATE_LIMIT_WINDOW * 1000)
@@ -0,0 +1,54 @@
+from app.usecases import tokens as tokens_usecases
+from app.common.context import Context
+from app.common import serial
+from app.common import settings
+
+import random
+
+RESTART_KEY = f"akatsuki:restarts:{settings.INSTANCE_ID}"
+
+RESTART_MSG = "Akatsuki is restarting. You will be reconnected shortly!"
+
+
+def get_reconnect_delay() -> int:
+    """Returns a random delay within the restart window, in milliseconds, so
+    clients don't all reconnect at once."""
+    return random.randint(0, settings.RESTART_WINDOW * 1000)
+
+
+def write_restart_packets() -> bytes:
+    return serial.write_notification_packet(
+        RESTART_MSG
+    ) + serial.write_server_restart_packet(get_reconnect_delay())
+
+
+async def begin_restart(ctx: Context) -> bool:
+    """Returns whether this worker began the instance's restart, rather than
+    another one of its workers."""
+    began = await ctx.redis.set(
+        RESTART_KEY,
+        1,
+        nx=True,
+        px=settings.RESTART_WINDOW * 1000,
+    )
+    return began is not None
+
+
+async def end_restart(ctx: Context) -> None:
+    await ctx.redis.delete(RESTART_KEY)
+
+
+async def log_out_instance_tokens(ctx: Context) -> int:
+    """Logs out every token this instance created, returning how many there were.
+
+    Their clients' next polls get restart packets, each with its own delay."""
+    tokens = await tokens_usecases.fetch_all(ctx, instance_id=settings.INSTANCE_ID)
+    token_ids = [
+        token.token_id
+        for token in tokens
+        # the bot is shared by every instance
+        if token.user_id != 999
+    ]
+
+    await tokens_usecases.logout_many(ctx, token_ids)
+    return len(token_ids)
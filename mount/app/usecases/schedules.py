@@ -0,0 +1,174 @@
+from app.repositories.schedules import SchedulesRepository
+from app.repositories.schedules import FREEZES_KEY
+from app.repositories.schedules import DONOR_EXPIRIES_KEY
+from app.usecases import users as users_usecases
+from app.usecases import tokens as tokens_usecases
+from app.usecases import logging as logging_usecases
+from app.common.context import Context
+from app.common import logger
+from app.common import settings
+from app.common.tasks import create_isolated_task
+from app.models.privileges import Privileges
+from typing import Awaitable
+from typing import Callable
+
+import asyncio
+import time
+
+FREEZE_RESTRICTED_MSG = "\n".join(
+    [
+        "Your account has been automatically restricted due to an account freeze being left unhandled for over 7 days.",
+        "You are still welcome to liveplay, although your account will remain in restricted mode unless this is handled.",
+    ]
+)
+
+
+async def seed(ctx: Context) -> None:
+    """Queue every pending freeze and donor expiry from the database.
+
+    Both queries scan the users table, so only one worker seeds per interval."""
+    repo = SchedulesRepository(ctx)
+
+    if not await repo.claim_seed(settings.SCHEDULER_RESEED_INTERVAL * 1000):
+        return
+
+    frozen_users = await repo.fetch_frozen_users()
+    await repo.schedule(
+        FREEZES_KEY,
+        {user["id"]: user["frozen"] for user in frozen_users},
+    )
+
+    donors = await repo.fetch_donors()
+    await repo.schedule(
+        DONOR_EXPIRIES_KEY,
+        {user["id"]: user["donor_expire"] for user in donors},
+    )
+
+
+async def update_online_privileges(
+    ctx: Context,
+    user_id: int,
+    privileges: int,
+    notification: str,
+) -> None:
+    for token in await tokens_usecases.fetch_all(ctx, user_id=user_id):
+        await tokens_usecases.partial_update(ctx, token.token_id, privileges=privileges)
+        await tokens_usecases.enqueue_notification(ctx, token.token_id, notification)
+
+
+async def process_freeze(ctx: Context, user_id: int) -> None:
+    user = await users_usecases.fetch_one(ctx, id=user_id)
+    if user is None or not user.frozen:
+        return
+
+    repo = SchedulesRepository(ctx)
+
+    if user.frozen == 1:
+        restriction_time = await users_usecases.begin_freeze_timer(ctx, user.id)
+        await repo.schedule(FREEZES_KEY, {user.id: restriction_time})
+        return
+
+    if user.frozen > int(time.time()):
+        await repo.schedule(FREEZES_KEY, {user.id: user.frozen})
+        return
+
+    privileges = await users_usecases.restrict(ctx, user.id, user.privileges)
+    await users_usecases.unfreeze(ctx, user.id, log=False)
+
+    await logging_usecases.rap(
+        ctx,
+        user.id,
+        "has been automatically restricted due to a pending freeze.",
+    )
+    await logging_usecases.anticheat(
+        f"[{user.username}](https://akatsuki.pw/u/{user.id}) has been automatically restricted due to a pending freeze.",
+        "ac_general",
+    )
+
+    await update_online_privileges(ctx, user.id, privileges, FREEZE_RESTRICTED_MSG)
+
+
+async def process_donor_expiry(ctx: Context, user_id: int) -> None:
+    user = await users_usecases.fetch_one(ctx, id=user_id)
+    if user is None or not user.privileges & Privileges.USER_DONOR:
+        return
+
+    if user.donor_expire > int(time.time()):
+        repo = SchedulesRepository(ctx)
+        await repo.schedule(DONOR_EXPIRIES_KEY, {user.id: user.donor_expire})
+        return
+
+    role_name = "premium" if user.privileges & Privileges.USER_PREMIUM else "supporter"
+    privileges = await users_usecases.revoke_supporter_privileges(
+        ctx,
+        user.id,
+        user.privileges,
+    )
+
+    notification = "\n".join(
+        [
+            f"Your {role_name} tag has expired.",
+            "Whether you continue to support us or not, we'd like to thank you "
+            "to the moon and back for your support so far - it really means everything to us.",
+            "- cmyui, and the Akatsuki Team",
+        ],
+    )
+    await update_online_privileges(ctx, user.id, privileges, notification)
+
+
+async def process_queue(
+    ctx: Context,
+    key: str,
+    process: Callable[[Context, int], Awaitable[None]],
+) -> int:
+    repo = SchedulesRepository(ctx)
+
+    due_user_ids = await repo.fetch_due(
+        key,
+        int(time.time()),
+        settings.SCHEDULER_BATCH_SIZE,
+    )
+
+    # another worker may have already claimed some of these users
+    user_ids = await repo.claim(key, due_user_ids)
+
+    semaphore = asyncio.Semaphore(settings.SCHEDULER_CONCURRENCY)
+    failures = 0
+
+    async def process_one(user_id: int) -> None:
+        nonlocal failures
+
+        async with semaphore:
+            try:
+                await process(ctx, user_id)
+            except Exception:
+                failures += 1
+                logger.error(
+                    "Failed to process scheduled user",
+                    queue=key,
+                    user_id=user_id,
+                    exc_info=True,
+                )
+
+    start_time = time.perf_counter()
+    await asyncio.gather(
+        *[create_isolated_task(process_one(user_id)) for user_id in user_ids]
+    )
+
+    if user_ids:
+        logger.info(
+            "Processed scheduled users",
+            queue=key,
+            processed=len(user_ids),
+            failed=failures,
+            pending=await repo.count(key),
+            elapsed_ms=round((time.perf_counter() - start_time) * 1000, 2),
+        )
+
+    return len(user_ids)
+
+
+async def process_due(ctx: Context) -> int:
+    processed = await process_queue(ctx, FREEZES_KEY, process_freeze)
+    processed += await process_queue(ctx, DONOR_EXPIRIES_KEY, process_donor_expiry)
+    return processed
@@ -1,15 +1,24 @@
 from app.repositories.streams import StreamsRepository
+from app.repositories.streams import RedisStreamsRepository
 from app.usecases import tokens as tokens_usecases
 from app.common.context import Context
+from app.common import settings
 from app.models.stream import Stream
 from typing import Any
 
 
+def get_repository(ctx: Context) -> StreamsRepository:
+    if settings.STREAM_BACKEND == "redis":
+        return RedisStreamsRepository(ctx)
+
+    return StreamsRepository(ctx)
+
+
 async def fetch_one(
     ctx: Context,
     stream_name: str,
 ) -> Stream | None:
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
 
     stream = await repo.fetch_one(stream_name)
     if stream is None:
@@ -19,7 +28,7 @@ async def fetch_one(
 
 
 async def fetch_all(ctx: Context) -> list[Stream]:
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
 
     streams = await repo.fetch_all()
     return [Stream.parse_obj(stream) for stream in streams]
@@ -29,17 +38,43 @@ async def fetch_clients(
     ctx: Context,
     stream_channel: str,
 ) -> list[str]:
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
 
     clients = await repo.fetch_clients(stream_channel)
     return [client["token_id"] for client in clients]
 
 
+async def fetch_client_streams(
+    ctx: Context,
+    token_id: str,
+) -> list[str]:
+    repo = get_repository(ctx)
+
+    streams = await repo.fetch_client_streams(token_id)
+    return [stream["stream_name"] for stream in streams]
+
+
+async def count_clients(
+    ctx: Context,
+    stream_name: str,
+) -> int:
+    repo = get_repository(ctx)
+    return await repo.count_clients(stream_name)
+
+
+async def count_clients_many(
+    ctx: Context,
+    stream_names: list[str],
+) -> list[int]:
+    repo = get_repository(ctx)
+    return await repo.count_clients_many(stream_names)
+
+
 async def create_one(
     ctx: Context,
     stream_name: str,
 ) -> Stream:
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
 
     stream = await repo.create_one(stream_name)
     return Stream.parse_obj(stream)
@@ -56,7 +91,7 @@ async def delete_one(
     for client in clients:
         await tokens_usecases.leave_stream(ctx, client, stream_name)
 
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
     await repo.delete_one(stream_name)
 
 
@@ -65,7 +100,7 @@ async def partial_update(
     stream_name: str,
     **updates: Any,
 ) -> Stream:
-    repo = StreamsRepository(ctx)
+    repo = get_repository(ctx)
 
     stream = await repo.partial_update(stream_name, **updates)
     return Stream.parse_obj(stream)
@@ -75,18 +110,40 @@ async def add_client(
     ctx: Context,
     stream_name: str,
     token_id: str,
-) -> None:
-    repo = StreamsRepository(ctx)
-    await repo.add_client(stream_name, token_id)
+) -> tuple[bool, int]:
+    """Returns whether the client was added, and the new client count."""
+    repo = get_repository(ctx)
+    return await repo.add_client(stream_name, token_id)
+
+
+async def add_clients(
+    ctx: Context,
+    stream_names: list[str],
+    token_id: str,
+) -> list[tuple[bool, int]]:
+    """Returns whether the client was added, and the new client count, per stream."""
+    repo = get_repository(ctx)
+    return await repo.add_clients(stream_names, token_id)
 
 
 async def remove_client(
     ctx: Context,
     stream_name: str,
     token_id: str,
-) -> None:
-    repo = StreamsRepository(ctx)
-    await repo.remove_client(stream_name, token_id)
+) -> tuple[bool, int]:
+    """Returns whether the client was removed, and the new client count."""
+    repo = get_repository(ctx)
+    return await repo.remove_client(stream_name, token_id)
+
+
+async def purge_clients(
+    ctx: Context,
+    token_ids: list[str],
+) -> dict[str, int]:
+    """Removes the clients from every stream, returning each affected stream's
+    remaining client count."""
+    repo = get_repository(ctx)
+    return await repo.purge_clients(token_ids)
 
 
 async def broadcast(
@@ -95,15 +152,11 @@ async def broadcast(
     data: bytes,
     ignore_list: list[str] | None = None,
 ) -> None:
-    stream = await fetch_one(ctx, stream_name)
-    assert stream is not None
-
     clients = await fetch_clients(ctx, stream_name)
-    for client in clients:
-        if ignore_list is not None and client in ignore_list:
-            continue
+    if ignore_list is not None:
+        clients = [client for client in clients if client not in ignore_list]
 
-        await tokens_usecases.enqueue(ctx, client, data)
+    await tokens_usecases.enqueue_many(ctx, clients, data)
 
 
 async def selective_broadcast(
@@ -112,8 +165,4 @@ async def selective_broadcast(
     data: bytes,
     clients: list[str],
 ) -> None:
-    stream = await fetch_one(ctx, stream_name)
-    assert stream is not None
-
-    for client in clients:
-        await tokens_usecases.enqueue(ctx, client, data)
+    await tokens_usecases.enqueue_many(ctx, clients, data)
@@ -1,6 +1,8 @@
 from app.models.token import Token
+from app.models.token import TokenSession
 from app.models.mode import Mode
 from app.models.action import Action
+from app.models.channel import Channel
 from app.models.privileges import Privileges
 from app.common.context import Context
 from app.repositories.tokens import TokensRepository
@@ -8,7 +10,9 @@ from app.usecases import streams as streams_usecases
 from app.usecases import users as users_usecases
 from app.usecases import stats as stats_usecases
 from app.usecases import channels as channels_usecases
+from app.common import logger
 from app.common import serial
+from app.common import settings
 from uuid import uuid4
 
 import time
@@ -30,18 +34,110 @@ async def fetch_one(
     return Token.parse_obj(token)
 
 
+async def fetch_session(
+    ctx: Context,
+    token_id: str | None = None,
+    user_id: int | None = None,
+    username: str | None = None,
+) -> TokenSession | None:
+    repo = TokensRepository(ctx)
+
+    session = await repo.fetch_one(
+        token_id,
+        user_id,
+        username,
+        fields=list(TokenSession.__fields__),
+    )
+    if session is None:
+        return None
+
+    return TokenSession.parse_obj(session)
+
+
+async def fetch_sessions(
+    ctx: Context,
+    token_ids: list[str],
+) -> list[TokenSession]:
+    repo = TokensRepository(ctx)
+
+    sessions = await repo.fetch_many(token_ids, fields=list(TokenSession.__fields__))
+    return [TokenSession.parse_obj(session) for session in sessions]
+
+
 async def fetch_all(
     ctx: Context,
     token_id: str | None = None,
     user_id: int | None = None,
     username: str | None = None,
+    instance_id: str | None = None,
 ) -> list[Token]:
     repo = TokensRepository(ctx)
 
-    tokens = await repo.fetch_all(token_id, user_id, username)
+    tokens = await repo.fetch_all(token_id, user_id, username, instance_id)
     return [Token.parse_obj(token) for token in tokens]
 
 
+def generate_token_id() -> str:
+    return str(uuid4())
+
+
+async def claim_session(ctx: Context, user_id: int, token_id: str) -> bool:
+    """Claims the user's single session for a token which is about to be created.
+
+    Claims left behind by tokens which no longer exist are taken over."""
+    repo = TokensRepository(ctx)
+
+    if not await _take_session_claim(repo, user_id, token_id):
+        return False
+
+    # tournament tokens hold no claim, but any live token still blocks a login
+    if await repo.fetch_one(user_id=user_id, fields=["token_id"]) is not None:
+        await repo.release_session_claims({token_id: user_id})
+        return False
+
+    return True
+
+
+async def _take_session_claim(
+    repo: TokensRepository,
+    user_id: int,
+    token_id: str,
+) -> bool:
+    claim_timeout = settings.SESSION_CLAIM_TIMEOUT * 1000
+    if await repo.claim_session(user_id, token_id, claim_timeout):
+        return True
+
+    claim = await repo.fetch_session_claim(user_id)
+    if claim is None:  # released in the meantime
+        return await repo.claim_session(user_id, token_id, claim_timeout)
+
+    claimed_token_id, pending = claim
+    if pending:  # another login is still creating its token
+        return False
+
+    if await repo.fetch_one(token_id=claimed_token_id, fields=["token_id"]):
+        return False
+
+    return await repo.replace_session_claim(
+        user_id,
+        claimed_token_id,
+        token_id,
+        claim_timeout,
+    )
+
+
+async def confirm_session(ctx: Context, user_id: int) -> None:
+    """Keeps the session claim for as long as its token lives."""
+    repo = TokensRepository(ctx)
+    await repo.confirm_session_claim(user_id)
+
+
+async def release_session(ctx: Context, user_id: int, token_id: str) -> None:
+    """Gives up a session claim whose token was never created."""
+    repo = TokensRepository(ctx)
+    await repo.release_session_claims({token_id: user_id})
+
+
 async def create_one(
     ctx: Context,
     user_id: int,
@@ -53,11 +149,18 @@ async def create_one(
     utc_offset: int,
     tournament: bool,
     block_non_friends_dm: bool,
+    country: int = 0,
+    latitude: float = 0.0,
+    longitude: float = 0.0,
+    token_id: str | None = None,
 ) -> Token:
     now = int(time.time())
 
+    stats = await stats_usecases.fetch_one(ctx, user_id, Mode.STD, relax_int=0)
+    assert stats is not None
+
     token_params = {
-        "token_id": str(uuid4()),
+        "token_id": token_id or generate_token_id(),
         "user_id": user_id,
         "username": username,
         "privileges": privileges,
@@ -70,10 +173,10 @@ async def create_one(
         "block_non_friends_dm": block_non_friends_dm,
         "spectating_token_id": None,
         "spectating_user_id": None,
-        "latitude": 0.0,
-        "longitude": 0.0,
+        "latitude": latitude,
+        "longitude": longitude,
         "ip": ip,
-        "country": 0,
+        "country": country,
         "away_message": None,
         "match_id": None,
         "last_np_beatmap_id": None,
@@ -81,6 +184,7 @@ async def create_one(
         "last_np_accuracy": None,
         "silence_end_time": silence_end_time,
         "protocol_version": 0,
+        "instance_id": settings.INSTANCE_ID,
         "spam_rate": 0,
         "action_id": Action.IDLE,
         "action_text": "",
@@ -90,33 +194,115 @@ async def create_one(
         "mode": Mode.STD,
         "relax": False,
         "autopilot": False,
-        "ranked_score": 0,
-        "accuracy": 0.0,
-        "playcount": 0,
-        "total_score": 0,
-        "global_rank": 0,
-        "pp": 0,
+        "ranked_score": stats.ranked_score,
+        "accuracy": stats.accuracy / 100,
+        "playcount": stats.playcount,
+        "total_score": stats.total_score,
+        "global_rank": stats.global_rank,
+        "pp": stats.pp,
     }
 
     token = Token.parse_obj(token_params)
     repo = TokensRepository(ctx)
-    await repo.create_one(**token_params)
 
-    token = await update_cached_stats(ctx, token.token_id)
-    await join_stream(ctx, token.token_id, stream_name="main")
+    # memory tables can't roll back, so undo a partial insert by hand
+    try:
+        await repo.create_one(**token_params)
+        await streams_usecases.add_client(ctx, "main", token.token_id)
+    except Exception:
+        await repo.delete_one(token.token_id)
+        await streams_usecases.purge_clients(ctx, [token.token_id])
+        raise
+
+    # the bot never polls, so it must never time out
+    if user_id != 999:
+        await repo.index_ping_time(token.token_id, now)
+
+    await update_presence(ctx, token)
 
     return token
 
 
+def get_client_privileges(privileges: int) -> int:
+    client_privileges = 1
+    if not users_usecases.is_restricted(privileges):
+        # "supporter"
+        client_privileges |= 4
+
+    if users_usecases.is_staff(privileges):
+        # "BAT"
+        client_privileges |= 2
+
+    if users_usecases.is_tournament_staff(privileges):
+        client_privileges |= 32
+
+    return client_privileges
+
+
+def write_presence_packet(token: Token) -> bytes:
+    return serial.write_user_presence_packet(
+        token.user_id,
+        token.username,
+        token.utc_offset,
+        token.country,
+        get_client_privileges(token.privileges),
+        token.mode,
+        token.latitude,
+        token.longitude,
+        token.global_rank,
+    )
+
+
+# token fields which are part of its presence packet
+PRESENCE_FIELDS = {
+    "username",
+    "privileges",
+    "utc_offset",
+    "country",
+    "mode",
+    "latitude",
+    "longitude",
+    "global_rank",
+}
+
+
+async def update_presence(ctx: Context, token: Token) -> None:
+    repo = TokensRepository(ctx)
+
+    if users_usecases.is_restricted(token.privileges):
+        await repo.delete_presences([token.token_id])
+    else:
+        await repo.set_presence(token.token_id, write_presence_packet(token))
+
+
+async def fetch_presence_snapshot(ctx: Context) -> bytes:
+    """Fetch the presences of every visible player, rebuilt at a bounded rate."""
+    snapshot = ctx.presence_snapshot
+
+    now = time.time()
+    if now - snapshot.built_at < settings.PRESENCE_SNAPSHOT_INTERVAL / 1000:
+        return snapshot.packets
+
+    repo = TokensRepository(ctx)
+
+    presences = await repo.fetch_presences()
+    snapshot.load(b"".join(presences), now)
+
+    return snapshot.packets
+
+
 async def partial_update(
     ctx: Context,
     token_id: str,
     **kwargs,
 ) -> Token:
     repo = TokensRepository(ctx)
-    new_token = await repo.partial_update(token_id, **kwargs)
+    new_token = Token.parse_obj(await repo.partial_update(token_id, **kwargs))
 
-    return Token.parse_obj(new_token)
+    if PRESENCE_FIELDS.intersection(kwargs):
+        await update_presence(ctx, new_token)
+
+    return new_token
 
 
 async def delete_one(
@@ -127,6 +313,77 @@ async def delete_one(
     await repo.delete_one(token_id)
 
 
+def update_ping_time(ctx: Context, token_id: str) -> None:
+    ctx.ping_buffer.record(token_id, int(time.time()))
+
+
+async def flush_ping_times(ctx: Context) -> None:
+    ping_times = ctx.ping_buffer.drain()
+    if not ping_times:
+        return
+
+    repo = TokensRepository(ctx)
+    await repo.update_ping_times(ping_times)
+
+
+async def logout(ctx: Context, token_id: str) -> None:
+    await logout_many(ctx, [token_id])
+
+
+async def logout_many(ctx: Context, token_ids: list[str]) -> None:
+    """Removes the tokens along with their memberships, buffers and ping times."""
+    tokens = await fetch_sessions(ctx, token_ids)
+    if not tokens:
+        return
+
+    token_ids = [token.token_id for token in tokens]
+    repo = TokensRepository(ctx)
+
+    # memory tables can't roll back; the tokens go last, so a logout that fails
+    # partway leaves them fetchable and retrying it finishes the cleanup
+    stream_client_counts = await streams_usecases.purge_clients(ctx, token_ids)
+    await repo.delete_buffers(token_ids)
+    await repo.delete_many(token_ids)
+
+    await repo.remove_ping_times(token_ids)
+    await repo.delete_presences(token_ids)
+    await repo.release_session_claims(
+        {token.token_id: token.user_id for token in tokens}
+    )
+
+    for stream_name, client_count in stream_client_counts.items():
+        if client_count != 0 or not stream_name.startswith("chat/"):
+            continue
+
+        channel = await channels_usecases.fetch_one(ctx, stream_name[len("chat/") :])
+        if channel is not None and channel.instance:
+            await channels_usecases.delete_one(ctx, channel.name)
+
+    logout_packets = b"".join(
+        serial.write_user_logout_packet(token.user_id)
+        for token in tokens
+        if not users_usecases.is_restricted(token.privileges)
+    )
+    if logout_packets:
+        await streams_usecases.broadcast(ctx, "main", logout_packets)
+
+
+async def expire_stale_tokens(ctx: Context) -> int:
+    repo = TokensRepository(ctx)
+
+    ping_cutoff = int(time.time()) - settings.PING_TIMEOUT
+    token_ids = await repo.fetch_stale_token_ids(
+        ping_cutoff,
+        settings.TOKEN_REAPER_BATCH_SIZE,
+    )
+
+    # another worker may have already claimed some of these tokens
+    claimed_token_ids = await repo.remove_ping_times(token_ids)
+    await logout_many(ctx, claimed_token_ids)
+
+    return len(claimed_token_ids)
+
+
 async def update_cached_stats(ctx: Context, token_id: str) -> Token:
     token = await fetch_one(ctx, token_id=token_id)
     assert token is not None
@@ -164,6 +421,17 @@ async def enqueue(
     await repo.enqueue(token_id, json_data)
 
 
+async def enqueue_many(
+    ctx: Context,
+    token_ids: list[str],
+    data: bytes,
+) -> None:
+    repo = TokensRepository(ctx)
+
+    json_data = list(data)
+    await repo.enqueue_many(token_ids, json_data)
+
+
 async def dequeue(
     ctx: Context,
     token_id: str,
@@ -179,7 +447,7 @@ async def join_stream(
     token_id: str,
     stream_name: str,
 ) -> None:
-    token = await fetch_one(ctx, token_id=token_id)
+    token = await fetch_session(ctx, token_id=token_id)
     assert token is not None
 
     stream = await streams_usecases.fetch_one(
@@ -198,7 +466,7 @@ async def leave_stream(
     token_id: str,
     stream_name: str,
 ) -> None:
-    token = await fetch_one(ctx, token_id=token_id)
+    token = await fetch_session(ctx, token_id=token_id)
     assert token is not None
 
     stream = await streams_usecases.fetch_one(
@@ -216,10 +484,10 @@ async def enqueue_message(
     message: str,
     sender_token_id: str,
 ) -> None:
-    token = await fetch_one(ctx, token_id=token_id)
+    token = await fetch_session(ctx, token_id=token_id)
     assert token is not None
 
-    sender = await fetch_one(ctx, token_id=sender_token_id)
+    sender = await fetch_session(ctx, token_id=sender_token_id)
     if sender is None:
         return
 
@@ -237,7 +505,7 @@ async def enqueue_bot_message(
     token_id: str,
     message: str,
 ) -> None:
-    bot = await fetch_one(ctx, user_id=999)
+    bot = await fetch_session(ctx, user_id=999)
     assert bot is not None
 
     await enqueue_message(ctx, token_id, message, bot.token_id)
@@ -271,7 +539,7 @@ async def enqueue_notification(
     token_id: str,
     message: str,
 ) -> None:
-    token = await fetch_one(ctx, token_id=token_id)
+    token = await fetch_session(ctx, token_id=token_id)
     assert token is not None
 
     packet = serial.write_notification_packet(message)
@@ -282,6 +550,28 @@ def get_remaining_silence_seconds(silence_end_time: int) -> int:
     return max(0, silence_end_time - int(time.time()))
 
 
+async def can_join_channel(
+    ctx: Context,
+    token: TokenSession,
+    channel: Channel,
+) -> bool:
+    if token.user_id == 999:
+        return True
+
+    return await channels_usecases.can_read(ctx, token.privileges, channel)
+
+
+async def can_write_channel(
+    ctx: Context,
+    token: TokenSession,
+    channel: Channel,
+) -> bool:
+    if token.user_id == 999:
+        return True
+
+    return await channels_usecases.can_write(ctx, token.privileges, channel)
+
+
 async def join_channel(
     ctx: Context,
     token_id: str,
@@ -291,31 +581,19 @@ async def join_channel(
     if not channel_name.startswith("#"):
         return
 
-    token = await fetch_one(ctx, token_id=token_id)
+    token = await fetch_session(ctx, token_id=token_id)
     assert token is not None
 
     channel = await channels_usecases.fetch_one(ctx, channel_name)
     assert channel is not None
 
-    joined_channels = [
-        client["channel_name"]
-        for client in await channels_usecases.fetch_clients(ctx, token_id=token_id)
-    ]
-    if channel_name in joined_channels:
+    if not await can_join_channel(ctx, token, channel):
         return
 
-    if (
-        (channel_name == "#premium" and not token.privileges & Privileges.USER_PREMIUM)
-        or (
-            channel_name == "#supporter"
-            and not token.privileges & Privileges.USER_DONOR
-        )
-        or (not channel.public_read and not users_usecases.is_staff(token.privileges))
-    ) and token.user_id != 999:
+    joined, _ = await channels_usecases.add_client(ctx, channel_name, token_id)
+    if not joined:
         return
 
-    await join_stream(ctx, token_id, f"chat/{channel_name}")
-
     client_name = channels_usecases.get_client_name(channel_name)
     await enqueue(
         ctx,
@@ -324,6 +602,54 @@ async def join_channel(
     )
 
 
+async def join_channels(
+    ctx: Context,
+    token_id: str,
+    channel_names: list[str],
+    auto_join: bool = False,
+) -> None:
+    token = await fetch_session(ctx, token_id=token_id)
+    assert token is not None
+
+    channels: list[Channel] = []
+    for channel_name in channel_names:
+        # private messages
+        if not channel_name.startswith("#"):
+            continue
+
+        channel = await channels_usecases.fetch_one(ctx, channel_name)
+        if channel is None:
+            logger.warning("Skipped joining unknown channel", channel_name=channel_name)
+            continue
+
+        if await can_join_channel(ctx, token, channel):
+            channels.append(channel)
+
+    results = await channels_usecases.add_clients(
+        ctx,
+        [channel.name for channel in channels],
+        token_id,
+    )
+
+    packets = bytearray()
+    for channel, (joined, client_count) in zip(channels, results):
+        if not joined:
+            continue
+
+        client_name = channels_usecases.get_client_name(channel.name)
+        if auto_join:
+            packets += serial.write_channel_auto_join_packet(
+                client_name,
+                channel.description,
+                client_count,
+            )
+
+        packets += serial.write_channel_join_success_packet(client_name)
+
+    if packets:
+        await enqueue(ctx, token_id, bytes(packets))
+
+
 async def leave_channel(
     ctx: Context,
     token_id: str,
@@ -334,19 +660,17 @@ async def leave_channel(
     if not channel_name.startswith("#"):
         return
 
-    token = await fetch_one(ctx, token_id=token_id)
-    assert token is not None
-
     client_channel = channel_name
-    if channel_name == "#spectator":
-        if token.spectating_user_id is None:
-            user_id = token.user_id
+    if channel_name in ("#spectator", "#multiplayer"):
+        token = await fetch_one(ctx, token_id=token_id)
+        assert token is not None
+
+        if channel_name == "#multiplayer":
+            channel_name = f"#multi_{token.match_id}"
+        elif token.spectating_user_id is None:
+            channel_name = f"#spect_{token.user_id}"
         else:
-            user_id = token.spectating_user_id
-
-        channel_name = f"#spect_{user_id}"
-    elif channel_name == "#multiplayer":
-        channel_name = f"#multi_{token.match_id}"
+            channel_name = f"#spect_{token.spectating_user_id}"
     elif channel_name.startswith("#spect_"):
         client_channel = "#spectator"
     elif channel_name.startswith("#multi_"):
@@ -355,28 +679,16 @@ async def leave_channel(
     channel = await channels_usecases.fetch_one(ctx, channel_name)
     assert channel is not None
 
-    channel_clients = await channels_usecases.fetch_clients(
+    left, client_count = await channels_usecases.remove_client(
         ctx,
-        channel_name=channel_name,
+        channel_name,
+        token_id,
     )
-    if token_id not in channel_clients:
+    if not left:
         return
 
-    stream = await streams_usecases.fetch_one(ctx, f"chat/{channel_name}")
-    assert stream is not None
-
-    await channels_usecases.remove_client(ctx, channel_name, token_id)
-
-    stream_clients = await streams_usecases.fetch_clients(ctx, f"chat/{channel_name}")
-    if token_id not in stream_clients:
-        new_stream_count = len(stream_clients)
-    else:
-        new_stream_count = len(stream_clients) - 1
-
-    if channel.instance and new_stream_count == 0:
+    if channel.instance and client_count == 0:
         await channels_usecases.delete_one(ctx, channel_name)
-    else:
-        await streams_usecases.remove_client(ctx, f"chat/{channel_name}", token_id)
 
     if kick:
         await enqueue(
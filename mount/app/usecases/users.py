@@ -56,8 +56,11 @@ def is_tournament_staff(privileges: int) -> bool:
     return privileges & Privileges.USER_TOURNAMENT_STAFF != 0
 
 
+FREEZE_DURATION = 86_400 * 7
+
+
 async def begin_freeze_timer(ctx: Context, user_id: int) -> int:
-    restriction_time = int(time.time() + (86_400 * 7))
+    restriction_time = int(time.time() + FREEZE_DURATION)
 
     await partial_update(ctx, user_id, frozen=restriction_time)
     return restriction_time
@@ -0,0 +1,6 @@
+alter table tokens engine = innodb;
+alter table token_states engine = innodb;
+alter table streams engine = innodb;
+alter table stream_tokens engine = innodb;
+alter table channel_tokens engine = innodb;
+alter table channels engine = innodb;
@@ -0,0 +1,8 @@
+-- ephemeral session state is rebuilt on startup, so skip durability for it.
+-- token_buffers keeps innodb, since memory tables cannot store json columns.
+alter table tokens engine = memory;
+alter table token_states engine = memory;
+alter table streams engine = memory;
+alter table stream_tokens engine = memory;
+alter table channel_tokens engine = memory;
+alter table channels engine = memory;
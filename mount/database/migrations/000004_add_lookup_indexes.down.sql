@@ -0,0 +1,5 @@
+drop index tokens_user_id_idx on tokens;
+drop index tokens_username_idx on tokens;
+drop index token_buffers_token_id_buffer_id_idx on token_buffers;
+drop index stream_tokens_token_id_idx on stream_tokens;
+drop index channel_tokens_token_id_idx on channel_tokens;
@@ -0,0 +1,5 @@
+create index tokens_user_id_idx on tokens (user_id);
+create index tokens_username_idx on tokens (username);
+create index token_buffers_token_id_buffer_id_idx on token_buffers (token_id, buffer_id);
+create index stream_tokens_token_id_idx on stream_tokens (token_id);
+create index channel_tokens_token_id_idx on channel_tokens (token_id);
@@ -0,0 +1,6 @@
+create table if not exists channel_tokens (
+    channel_name varchar(255) not null,
+    token_id varchar(64) not null,
+    primary key (channel_name, token_id),
+    index channel_tokens_token_id_idx (token_id)
+) engine = memory;
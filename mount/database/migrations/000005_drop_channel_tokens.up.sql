@@ -0,0 +1,2 @@
+-- channel membership is the membership of the channel's chat/ stream
+drop table if exists channel_tokens;
@@ -0,0 +1,2 @@
+drop index tokens_instance_id_idx on tokens;
+alter table tokens drop column instance_id;
@@ -0,0 +1,3 @@
+-- graceful restarts only log out the tokens created by the instance shutting down
+alter table tokens add column instance_id varchar(64) not null default '';
+create index tokens_instance_id_idx on tokens (instance_id);
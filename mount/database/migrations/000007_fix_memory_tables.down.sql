@@ -0,0 +1,13 @@
+alter table channels
+    drop primary key,
+    add primary key (name);
+alter table stream_tokens
+    drop primary key,
+    add primary key (stream_name, token_id),
+    drop index stream_tokens_token_id_idx,
+    add index stream_tokens_token_id_idx (token_id);
+alter table streams
+    drop primary key,
+    add primary key (name);
+alter table token_states engine = memory;
+alter table tokens engine = memory;
@@ -0,0 +1,22 @@
+-- memory tables store varchar columns at full width, so the ~2.5 KB token rows
+-- would fill max_heap_table_size (16 MB by default) within a few thousand
+-- online users. the tokens go back to innodb.
+alter table tokens engine = innodb;
+alter table token_states engine = innodb;
+
+-- memory indexes default to hash, which can't serve lookups on a prefix of a
+-- composite key, so rebuild them as btrees.
+-- stream_tokens rows take ~1.3 KB each, so max_heap_table_size must fit every
+-- online user's stream memberships (e.g. 10k users in ~5 streams needs ~64 MB),
+-- and must be raised before this migration runs for the limit to apply.
+alter table streams
+    drop primary key,
+    add primary key using btree (name);
+alter table stream_tokens
+    drop primary key,
+    add primary key using btree (stream_name, token_id),
+    drop index stream_tokens_token_id_idx,
+    add index stream_tokens_token_id_idx using btree (token_id);
+alter table channels
+    drop primary key,
+    add primary key using btree (name);
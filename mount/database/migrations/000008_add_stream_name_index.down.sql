@@ -0,0 +1 @@
+drop index stream_tokens_stream_name_idx on stream_tokens;
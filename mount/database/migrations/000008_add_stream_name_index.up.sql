@@ -0,0 +1,2 @@
+-- stream clients are looked up and counted by stream name on every broadcast
+create index stream_tokens_stream_name_idx using btree on stream_tokens (stream_name);